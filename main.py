@@ -1,4 +1,17 @@
+import asyncio
+from contextlib import asynccontextmanager
+from time import perf_counter
 from fastapi import FastAPI
+from loguru import logger
+
+from src.database import init_database, init_schema, close_database, db, run_in_db
+from src.config import settings
+from src.http_client import close_sessions
+from src.cache.backend import close_backends
+from src.plan_catalog import plan_catalog
+from src.check_in.ignore_rules import ignore_rules
+from src.check_in.buffer import check_in_buffer
+from src.order.outbox import webhook_worker
 from src.order.query_order import router as order_query_router
 from src.order.transfer_order import router as order_transfer_router
 from src.order.afdian.webhook import router as order_afdian_webhook_router
@@ -9,7 +22,67 @@ from src.check_in import router as check_in_router
 from src.revenue import router as revenue_router
 from src.reward import router as reward_router
 
-app = FastAPI()
+
+async def timed(timings: dict, name: str, coro):
+    start = perf_counter()
+    try:
+        return await coro
+    finally:
+        timings[name] = perf_counter() - start
+
+
+async def warm_up_db_pool():
+    # 提前把线程池里的连接建好，避免第一批请求排队建连接
+    count = min(settings.database_max_workers, settings.database_max_connections)
+    await asyncio.gather(*(run_in_db(db.execute_sql, "SELECT 1") for _ in range(count)))
+
+
+# 互相独立的预热步骤，启动时并行执行
+WARMUP_STEPS = {
+    "db_pool": warm_up_db_pool,
+    "plan_catalog": plan_catalog.refresh,
+    "ignore_rules": ignore_rules.refresh,
+}
+
+
+async def warm_up(timings: dict):
+    await asyncio.gather(
+        *(
+            timed(timings, f"warmup.{name}", step())
+            for name, step in WARMUP_STEPS.items()
+        )
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    timings = {}
+    start = perf_counter()
+
+    await timed(timings, "database", asyncio.to_thread(init_database))
+    await timed(timings, "schema", run_in_db(init_schema))
+    await timed(timings, "warmup", warm_up(timings))
+
+    if settings.check_in_buffered:
+        check_in_buffer.start()
+    if settings.webhook_outbox:
+        webhook_worker.start()
+
+    timings["total"] = perf_counter() - start
+    report = ", ".join(f"{name}: {cost * 1000:.1f}ms" for name, cost in timings.items())
+    logger.success(f"startup finished, {report}")
+
+    yield
+
+    await check_in_buffer.stop()
+    await webhook_worker.stop()
+    await close_sessions()
+    await close_backends()
+    close_database()
+    logger.info("shutdown finished")
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(order_query_router)
 app.include_router(order_afdian_webhook_router)
@@ -0,0 +1,179 @@
+import asyncio
+import sys
+from collections import OrderedDict
+from time import monotonic
+from typing import Callable, Optional
+from loguru import logger
+
+
+SIZE_SAMPLE = 16  # 估算大列表内存时抽样的元素个数
+
+# name -> cache，用于统计
+caches = {}
+
+
+def estimate_size(value) -> int:
+    """
+    粗略估算对象占用的内存（字节），大列表只抽样前几个元素再按长度放大
+    """
+    size = sys.getsizeof(value)
+
+    if isinstance(value, dict):
+        return size + sum(
+            estimate_size(k) + estimate_size(v) for k, v in value.items()
+        )
+
+    if isinstance(value, (list, tuple, set, frozenset)):
+        if not value:
+            return size
+        items = list(value)[:SIZE_SAMPLE] if len(value) > SIZE_SAMPLE else value
+        sampled = sum(estimate_size(item) for item in items)
+        return size + sampled * len(value) // len(items)
+
+    return size
+
+
+class LRUCache:
+    """
+    按条目数和/或估算字节数限制大小的 LRU 缓存，带命中、未命中、淘汰计数
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        sizeof: Callable = estimate_size,
+    ):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        self._data = OrderedDict()  # key -> (value, size)
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        caches[name] = self
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._data.move_to_end(key)
+        return item[0]
+
+    def set(self, key, value):
+        self.delete(key)
+
+        size = self.sizeof(value) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            # 单条就超预算的不缓存
+            self.evictions += 1
+            return
+
+        self._data[key] = (value, size)
+        self.size_bytes += size
+        self._evict()
+
+    def _evict(self):
+        while self._data and (
+            (self.max_entries and len(self._data) > self.max_entries)
+            or (self.max_bytes and self.size_bytes > self.max_bytes)
+        ):
+            _, (_, size) = self._data.popitem(last=False)
+            self.size_bytes -= size
+            self.evictions += 1
+
+    def delete(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.size_bytes -= item[1]
+
+    def clear(self):
+        self._data.clear()
+        self.size_bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._data),
+            "bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TTLCache(LRUCache):
+    """
+    每个条目带过期时间的 LRU 缓存
+    """
+
+    def __init__(self, name: str, max_entries: int):
+        super().__init__(name, max_entries=max_entries)
+
+    def get(self, key, default=None):
+        item = super().get(key)
+        if item is None:
+            return default
+
+        value, expires_at = item
+        if expires_at <= monotonic():
+            # 过期的算未命中
+            self.hits -= 1
+            self.misses += 1
+            self.delete(key)
+            return default
+
+        return value
+
+    def set(self, key, value, ttl: float):
+        super().set(key, (value, monotonic() + ttl))
+
+
+def cache_stats() -> dict:
+    return {name: cache.stats() for name, cache in caches.items()}
+
+
+def run_in_background(coro, name: str) -> asyncio.Task:
+    """
+    后台执行，不等待结果，出错时记日志
+    """
+
+    def done(task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            logger.error(f"background task failed, name: {name}, error: {task.exception()}")
+
+    task = asyncio.ensure_future(coro)
+    task.add_done_callback(done)
+    return task
+
+
+class SingleFlight:
+    """
+    相同 key 的并发调用合并成一次，其余调用方等待同一个结果
+    """
+
+    def __init__(self):
+        self._tasks = {}
+
+    async def do(self, key, func, *args, **kwargs):
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+
+        # 某个调用方被取消时不影响其他在等的调用方
+        return await asyncio.shield(task)
+
+    def in_flight(self, key) -> bool:
+        return key in self._tasks
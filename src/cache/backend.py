@@ -0,0 +1,156 @@
+import hashlib
+import json
+from abc import ABC, abstractmethod
+from typing import Callable, Optional
+from loguru import logger
+
+from src.config import settings
+from . import LRUCache, TTLCache, caches
+from .resp import RedisClient, RedisError
+
+
+REDIS_KEY_PREFIX = "billing"
+
+_redis_client: Optional[RedisClient] = None
+
+
+def identity(value):
+    return value
+
+
+class CacheBackend(ABC):
+    """
+    异步缓存接口。memory 是每个进程各自一份，redis 是多个 worker 共享一份
+    """
+
+    @abstractmethod
+    async def get(self, key):
+        ...
+
+    @abstractmethod
+    async def set(self, key, value, ttl: Optional[float] = None):
+        ...
+
+    @abstractmethod
+    async def delete(self, key):
+        ...
+
+
+class MemoryBackend(CacheBackend):
+    def __init__(self, cache: LRUCache):
+        self.cache = cache
+
+    async def get(self, key):
+        return self.cache.get(key)
+
+    async def set(self, key, value, ttl: Optional[float] = None):
+        if isinstance(self.cache, TTLCache):
+            self.cache.set(key, value, ttl)
+        else:
+            # LRUCache 只按容量淘汰，不看 ttl
+            self.cache.set(key, value)
+
+    async def delete(self, key):
+        self.cache.delete(key)
+
+
+class RedisBackend(CacheBackend):
+    """
+    值用 encode 转成可以 JSON 序列化的结构存进 redis，读出来再 decode。
+    redis 出错时当作未命中，不影响请求本身。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        client: RedisClient,
+        encode: Callable = identity,
+        decode: Callable = identity,
+    ):
+        self.name = name
+        self.client = client
+        self.encode = encode
+        self.decode = decode
+
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+        caches[name] = self
+
+    def _key(self, key) -> str:
+        # key 里可能有 rid 等敏感信息，哈希后再存
+        digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+        return f"{REDIS_KEY_PREFIX}:{self.name}:{digest}"
+
+    async def get(self, key):
+        try:
+            raw = await self.client.execute("GET", self._key(key))
+        except RedisError as e:
+            self.errors += 1
+            logger.warning(f"redis get failed, cache: {self.name}, error: {e}")
+            return None
+
+        if raw is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return self.decode(json.loads(raw))
+
+    async def set(self, key, value, ttl: Optional[float] = None):
+        payload = json.dumps(self.encode(value), separators=(",", ":"))
+        args = ["SET", self._key(key), payload]
+        if ttl:
+            args += ["PX", int(ttl * 1000)]
+
+        try:
+            await self.client.execute(*args)
+        except RedisError as e:
+            self.errors += 1
+            logger.warning(f"redis set failed, cache: {self.name}, error: {e}")
+
+    async def delete(self, key):
+        try:
+            await self.client.execute("DEL", self._key(key))
+        except RedisError as e:
+            self.errors += 1
+            logger.warning(f"redis delete failed, cache: {self.name}, error: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "backend": "redis",
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+        }
+
+
+def get_redis_client() -> RedisClient:
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = RedisClient(settings.cache_redis_url)
+    return _redis_client
+
+
+def create_backend(
+    name: str,
+    local: Callable[[], LRUCache],
+    encode: Callable = identity,
+    decode: Callable = identity,
+) -> CacheBackend:
+    """
+    按 settings.cache_backend 创建缓存，local 用来创建进程内的 LRUCache
+    """
+    if settings.cache_backend == "redis":
+        return RedisBackend(name, get_redis_client(), encode, decode)
+    if settings.cache_backend == "memory":
+        return MemoryBackend(local())
+    raise ValueError(f"unknown cache backend: {settings.cache_backend}")
+
+
+async def close_backends():
+    global _redis_client
+    if _redis_client is not None:
+        await _redis_client.close()
+        _redis_client = None
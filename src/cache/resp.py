@@ -0,0 +1,130 @@
+import asyncio
+from typing import Optional
+from urllib.parse import urlparse
+from loguru import logger
+
+
+REDIS_TIMEOUT = 2  # seconds，连接和单条命令的超时
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisClient:
+    """
+    最小的 Redis 协议（RESP2）客户端，只有一条连接，命令串行执行。
+    url: redis://[:password@]host[:port][/db]
+    """
+
+    def __init__(self, url: str):
+        parsed = urlparse(url)
+        if parsed.scheme != "redis":
+            raise ValueError(f"unsupported redis url: {url}")
+
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), REDIS_TIMEOUT
+        )
+        try:
+            if self.password:
+                await asyncio.wait_for(self._call("AUTH", self.password), REDIS_TIMEOUT)
+            if self.db:
+                await asyncio.wait_for(self._call("SELECT", self.db), REDIS_TIMEOUT)
+        except BaseException:
+            # 没认证 / 没切库的连接不能留着给后面的命令用
+            self._drop()
+            raise
+        logger.info(f"redis connected, host: {self.host}, port: {self.port}, db: {self.db}")
+
+    async def execute(self, *args):
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    await self._connect()
+                return await asyncio.wait_for(self._call(*args), REDIS_TIMEOUT)
+            except RedisError:
+                # 服务端返回的错误，回复已经读完，连接还能用
+                raise
+            except BaseException as e:
+                # 命令发出去了但回复没读完（包括调用方被取消），这条回复还留在连接上，
+                # 下一条命令会把它当成自己的结果，所以连接必须丢掉
+                self._drop()
+                if isinstance(
+                    e, (OSError, EOFError, asyncio.IncompleteReadError, asyncio.TimeoutError)
+                ):
+                    raise RedisError(f"redis connection error: {e!r}") from e
+                raise
+
+    async def _call(self, *args):
+        self._writer.write(encode_command(args))
+        await self._writer.drain()
+        reply = await self._read_reply()
+        if isinstance(reply, RedisError):
+            raise reply
+        return reply
+
+    async def _read_reply(self):
+        line = await self._reader.readuntil(b"\r\n")
+        prefix, body = line[:1], line[1:-2]
+
+        if prefix == b"+":
+            return body.decode()
+        if prefix == b"-":
+            # 不在这里抛，数组里的错误后面还有没读完的元素
+            return RedisError(body.decode())
+        if prefix == b":":
+            return int(body)
+        if prefix == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2]
+        if prefix == b"*":
+            length = int(body)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+
+        # 协议错乱，连接不能再用
+        raise ConnectionError(f"unknown redis reply: {line!r}")
+
+    def _drop(self):
+        # 同步关闭，被取消时也能执行完
+        writer, self._reader, self._writer = self._writer, None, None
+        if writer is not None:
+            writer.close()
+        return writer
+
+    async def _reset(self):
+        writer = self._drop()
+        if writer is not None:
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def close(self):
+        async with self._lock:
+            await self._reset()
+
+
+def encode_command(args) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, bytes):
+            data = arg
+        else:
+            data = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
@@ -1,9 +1,9 @@
-from aiohttp import ClientSession
 from loguru import logger
 from datetime import datetime
 from typing import Optional
 
 from src.config import settings
+from src.http_client import get_session
 from src.exception_notifer import exception_notify
 
 
@@ -14,14 +14,13 @@ async def acquire_cdk(expireTime: datetime, group: str) -> Optional[str]:
     }
 
     try:
-        async with ClientSession() as session:
-            async with session.post(
-                settings.cdk_acquire_api, json=query_body
-            ) as response:
-                response = await response.json()
-                logger.debug(
-                    f"url: {settings.cdk_acquire_api}, query_body: {query_body}, response: {response}"
-                )
+        async with get_session("cdk").post(
+            settings.cdk_acquire_api, json=query_body
+        ) as response:
+            response = await response.json()
+            logger.debug(
+                f"url: {settings.cdk_acquire_api}, query_body: {query_body}, response: {response}"
+            )
     except Exception as e:
         logger.error(f"Query CDK failed, error: {e}")
         await exception_notify("Auth", e)
@@ -1,8 +1,8 @@
-from aiohttp import ClientSession
 from loguru import logger
 from datetime import datetime
 
 from src.config import settings
+from src.http_client import get_session
 from src.exception_notifer import exception_notify
 
 
@@ -13,10 +13,9 @@ async def renew_cdk(cdk: str, expireTime: datetime) -> bool:
     }
 
     try:
-        async with ClientSession() as session:
-            async with session.post(settings.cdk_renew_api, json=query_body) as response:
-                response = await response.json()
-                logger.debug(f"url: {settings.cdk_renew_api}, query_body: {query_body}, response: {response}")
+        async with get_session("cdk").post(settings.cdk_renew_api, json=query_body) as response:
+            response = await response.json()
+            logger.debug(f"url: {settings.cdk_renew_api}, query_body: {query_body}, response: {response}")
     except Exception as e:
         logger.error(f"Renew CDK failed, error: {e}")
         await exception_notify("Auth", e)
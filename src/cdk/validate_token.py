@@ -1,35 +1,71 @@
-from aiohttp import ClientSession
+import hashlib
+from functools import lru_cache
+from typing import Optional
 from loguru import logger
 
+from src.cache import TTLCache, SingleFlight
+from src.cache.backend import create_backend
 from src.config import settings
+from src.http_client import get_session
 from src.exception_notifer import exception_notify
 
 
+TOKEN_CACHE_SIZE = 4096
+TOKEN_CACHE_TTL = 60  # seconds
+TOKEN_NEGATIVE_CACHE_TTL = 10  # seconds
+
+
+@lru_cache
+def get_token_cache():
+    # 第一次用到时才按配置创建，import 时不读配置
+    return create_backend("token", lambda: TTLCache("token", TOKEN_CACHE_SIZE))
+
+
+token_flight = SingleFlight()
+
+
 async def validate_token(rid: str, token: str) -> bool:
+    # 不直接拿 token 当 key，避免明文留在内存里
+    key = (rid, hashlib.sha256(token.encode()).hexdigest())
+
+    valid = await get_token_cache().get(key)
+    if valid is not None:
+        logger.debug(f"validate token cache hit, rid: {rid}, valid: {valid}")
+        return valid
+
+    valid = await token_flight.do(key, request_validate, key, rid, token)
+    return bool(valid)
+
+
+async def request_validate(key, rid: str, token: str) -> Optional[bool]:
+    """
+    请求 cdk 后端校验 token，请求失败返回 None 并且不缓存
+    """
     query_params = {
         "rid": rid,
         "token": token,
     }
 
     try:
-        async with ClientSession() as session:
-            async with session.post(
-                settings.cdk_validate_api, params=query_params
-            ) as response:
-                response = await response.json()
-                logger.debug(f"response: {response}")
+        async with get_session("cdk").post(
+            settings.cdk_validate_api, params=query_params
+        ) as response:
+            response = await response.json()
+            logger.debug(f"response: {response}")
     except Exception as e:
         logger.error(
             f"failed to request, url: {settings.cdk_validate_api}, query_params: {query_params}, error: {e}"
         )
         await exception_notify("Auth", e)
-        return False
+        return None
 
     if response.get("code", -1) != 0:
         logger.error(
             f"failed to validate token, response: {response}, url: {settings.cdk_validate_api}, query_params: {query_params}"
         )
+        await get_token_cache().set(key, False, TOKEN_NEGATIVE_CACHE_TTL)
         return False
 
     logger.success(f"validate token success, rid: {rid}")
+    await get_token_cache().set(key, True, TOKEN_CACHE_TTL)
     return True
@@ -1,75 +1,203 @@
+from typing import Optional, Tuple
 from loguru import logger
 from fastapi import APIRouter
 from datetime import datetime
+from peewee import chunked
 
 from src.config import settings
-from src.database import CheckIn, IgnoreCheckIn
+from src.database import CheckIn, db, run_in_db
+from src.database.rollup import apply_deltas, collect_checkin_deltas, rollup_checkins
+from .ignore_rules import ignore_rules
+from .buffer import check_in_buffer
 
 
 router = APIRouter()
 
+CHECK_IN_CHUNK_SIZE = 500
+
 
 @router.post("/check_in/" + settings.check_in_secret)
 async def check_in(body: dict):
     # logger.debug(f"body: {body}")
 
     now = datetime.now()
+    ignore_rules.ensure_fresh()
+
+    if settings.check_in_buffered:
+        return await check_in_buffered(body, now)
 
-    ret = True
     if "list" in body:
-        for item in body["list"]:
-            ret &= check_in_single(item, now)
+        failed = await run_in_db(check_in_list, body["list"], now)
+        if failed:
+            return {
+                "ec": 500,
+                "em": f"some failed to checkin, body: {body}",
+                "failed": failed,
+            }
 
-    else:
-        ret = check_in_single(body, now)
+        return {"ec": 200, "em": "OK"}
 
+    ret = await run_in_db(check_in_single, body, now)
     if not ret:
         return {"ec": 500, "em": f"some failed to checkin, body: {body}"}
 
     return {"ec": 200, "em": "OK"}
 
 
-def check_in_single(item, now) -> bool:
+async def check_in_buffered(body: dict, now):
+    items = body["list"] if "list" in body else [body]
+    rows, failed = prepare_check_ins(items, now)
+
+    if rows and not await check_in_buffer.put(rows):
+        return {"ec": 503, "em": "check_in is busy, please retry later"}
+
+    if failed:
+        return {
+            "ec": 500,
+            "em": f"some failed to checkin, body: {body}",
+            "failed": failed,
+        }
+
+    return {"ec": 200, "em": "OK"}
+
+
+def prepare_check_in(item, now) -> Tuple[Optional[dict], Optional[str]]:
+    """
+    校验单条 check_in，返回 (row, error)，被忽略的返回 (None, None)
+    """
+    if not isinstance(item, dict):
+        logger.error(f"invalid check_in item: {item}")
+        return None, "invalid item"
+
     cdk = item.get("cdk", "")
     application = item.get("application", "")
     if not cdk or not application:
         logger.error(f"no cdk or application field")
-        return False
+        return None, "no cdk or application field"
 
     module = item.get("module", "")
     user_agent = item.get("user_agent", "")
 
-    if application and IgnoreCheckIn.get_or_none(application=application):
-        logger.warning(f"ignore check_in, application: {application}")
-        return True
-    
-    if module and IgnoreCheckIn.get_or_none(module=module):
-        logger.warning(f"ignore check_in, module: {module}")
-        return True
-    
-    if user_agent and IgnoreCheckIn.get_or_none(user_agent=user_agent):
-        logger.warning(f"ignore check_in, user_agent: {user_agent}")
-        return True
+    ignored = ignore_rules.match(application, module, user_agent)
+    if ignored:
+        logger.warning(f"ignore check_in, {ignored}: {item.get(ignored)}")
+        return None, None
+
+    row = {
+        "cdk": cdk,
+        "activated_at": now,
+        "application": application,
+        "module": module,
+        "user_agent": user_agent,
+    }
+    return row, None
+
+
+def prepare_check_ins(items, now) -> Tuple[list, list]:
+    """
+    在内存里校验、去重一批 check_in，返回 (rows, failed)
+    """
+    failed = []
+    rows = {}  # cdk -> row，同一批里重复的 cdk 只保留第一条
+    for index, item in enumerate(items):
+        row, error = prepare_check_in(item, now)
+        if error:
+            failed.append({"index": index, "error": error})
+        elif row and row["cdk"] not in rows:
+            rows[row["cdk"]] = row
+
+    return list(rows.values()), failed
+
+
+def write_check_ins(rows: list) -> list:
+    """
+    按 chunk 一次查出已存在的 cdk、一条 INSERT 写入剩下的，全部在一个事务里。
+    汇总的增量攒到最后一次性按顺序写，避免和其他事务交叉加锁。
+    返回新写入的行。
+    """
+    # 缓冲模式下一批里混着多个请求，同一个 cdk 只保留第一条
+    unique = {}
+    for row in rows:
+        unique.setdefault(row["cdk"], row)
+    rows = list(unique.values())
+
+    created = []
+    deltas = {}
+    with db.atomic():
+        for chunk in chunked(rows, CHECK_IN_CHUNK_SIZE):
+            cdks = [row["cdk"] for row in chunk]
+            existing = {
+                checkin.cdk
+                for checkin in CheckIn.select(CheckIn.cdk).where(CheckIn.cdk << cdks)
+            }
+
+            new_rows = [row for row in chunk if row["cdk"] not in existing]
+            if new_rows:
+                CheckIn.insert_many(new_rows).execute()
+                collect_checkin_deltas(deltas, new_rows)
+                created.extend(new_rows)
+
+        apply_deltas(deltas)
+
+    return created
+
+
+def check_in_list(items, now) -> list:
+    """
+    批量 check_in，返回失败的条目
+    """
+    rows, failed = prepare_check_ins(items, now)
+    if not rows:
+        return failed
 
     try:
-        checkin, created = CheckIn.get_or_create(
-            cdk=cdk,
-            defaults={
-                "activated_at": now,
-                "application": application,
-                "module": module,
-                "user_agent": user_agent,
-            },
+        created = write_check_ins(rows)
+    except Exception as e:
+        logger.error(f"check_in list failed, count: {len(rows)}, error: {e}")
+        # 写库失败时整批都算失败
+        failed_index = {f["index"] for f in failed}
+        failed.extend(
+            {"index": index, "error": "write failed"}
+            for index in range(len(items))
+            if index not in failed_index
         )
+        return sorted(failed, key=lambda x: x["index"])
+
+    logger.success(
+        f"check_in list success, total: {len(items)}, created: {len(created)}, failed: {len(failed)}"
+    )
+    return failed
+
+
+def check_in_single(item, now) -> bool:
+    row, error = prepare_check_in(item, now)
+    if error:
+        return False
+    if not row:
+        return True
+
+    try:
+        with db.atomic():
+            checkin, created = CheckIn.get_or_create(
+                cdk=row["cdk"],
+                defaults={
+                    "activated_at": row["activated_at"],
+                    "application": row["application"],
+                    "module": row["module"],
+                    "user_agent": row["user_agent"],
+                },
+            )
+            if created:
+                rollup_checkins([row])
     except Exception as e:
         logger.error(
-            f"check_in failed, cdk: {cdk}, application: {application}, error: {e}"
+            f"check_in failed, cdk: {row['cdk']}, application: {row['application']}, error: {e}"
         )
         return False
 
     if created:
         logger.success(
-            f"check_in success, cdk: {cdk}, application: {application}, module: {module}, user_agent: {user_agent}"
+            f"check_in success, cdk: {row['cdk']}, application: {row['application']}, module: {row['module']}, user_agent: {row['user_agent']}"
         )
 
     return True
@@ -0,0 +1,98 @@
+import asyncio
+from loguru import logger
+
+from src.config import settings
+from src.database import run_in_db
+
+
+FLUSH_RETRY_TIMES = 3
+
+
+class CheckInBuffer:
+    """
+    写后缓冲：check_in 先进有界队列就直接返回，后台按条数或时间批量写库。
+    队列满时 put 会等待一会儿，还放不进去就返回 False 让调用方告诉客户端稍后重试。
+    """
+
+    def __init__(self):
+        self._queue: asyncio.Queue = None
+        self._task: asyncio.Task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=settings.check_in_buffer_size)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"check_in buffer started, size: {settings.check_in_buffer_size}")
+
+    async def put(self, rows: list) -> bool:
+        if not self.running:
+            return False
+
+        try:
+            for row in rows:
+                await asyncio.wait_for(
+                    self._queue.put(row), settings.check_in_enqueue_timeout
+                )
+        except asyncio.TimeoutError:
+            logger.error(f"check_in buffer is full, qsize: {self._queue.qsize()}")
+            return False
+
+        return True
+
+    async def stop(self):
+        if not self.running:
+            return
+
+        # None 作为结束标记，后台任务写完队列里剩下的再退出
+        await self._queue.put(None)
+        await self._task
+        logger.info("check_in buffer drained")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            row = await self._queue.get()
+            if row is None:
+                break
+
+            batch = [row]
+            deadline = loop.time() + settings.check_in_flush_interval
+            while len(batch) < settings.check_in_flush_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+
+                try:
+                    row = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+                if row is None:
+                    stopping = True
+                    break
+                batch.append(row)
+
+            await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        from . import write_check_ins
+
+        for i in range(1, FLUSH_RETRY_TIMES + 1):
+            try:
+                created = await run_in_db(write_check_ins, batch)
+                logger.success(
+                    f"check_in buffer flushed, batch: {len(batch)}, created: {len(created)}, qsize: {self._queue.qsize()}"
+                )
+                return
+            except Exception as e:
+                logger.error(f"check_in buffer flush failed, batch: {len(batch)}, times: {i}, error: {e}")
+                await asyncio.sleep(i * i)
+
+        logger.error(f"check_in buffer dropped batch, cdks: {[row['cdk'] for row in batch]}")
+
+
+check_in_buffer = CheckInBuffer()
@@ -0,0 +1,78 @@
+from time import monotonic
+from typing import Optional
+from loguru import logger
+
+from src.cache import SingleFlight, run_in_background
+from src.database import IgnoreCheckIn, db, run_in_db
+
+
+IGNORE_RULES_CHECK_INTERVAL = 60  # seconds，检查 ignore_checkin 表是否有变化的间隔
+
+
+class IgnoreRules:
+    """
+    ignore_checkin 表预先加载成 application / module / user_agent 三个集合，
+    判断是否忽略完全在内存里完成，表有变化（CHECKSUM TABLE）时重新加载。
+    """
+
+    FIELDS = ("application", "module", "user_agent")
+
+    def __init__(self):
+        self._rules = {field: frozenset() for field in self.FIELDS}
+        self._version = None
+        self._checked_at = None
+        self._flight = SingleFlight()
+
+    def load(self):
+        table = IgnoreCheckIn._meta.table_name
+        version = db.execute_sql(f"CHECKSUM TABLE {table}").fetchone()[1]
+        if self._checked_at is not None and version == self._version:
+            self._checked_at = monotonic()
+            return
+
+        rules = {field: set() for field in self.FIELDS}
+        for row in IgnoreCheckIn.select():
+            for field in self.FIELDS:
+                value = getattr(row, field)
+                if value:
+                    rules[field].add(value)
+
+        self._rules = {field: frozenset(values) for field, values in rules.items()}
+        self._version = version
+        self._checked_at = monotonic()
+        logger.info(
+            f"ignore rules loaded, {', '.join(f'{k}: {len(v)}' for k, v in self._rules.items())}"
+        )
+
+    async def refresh(self):
+        await self._flight.do("refresh", run_in_db, self.load)
+
+    def invalidate(self):
+        self._version = None
+        self._checked_at = None
+
+    def ensure_fresh(self):
+        if self._checked_at is not None and (
+            monotonic() - self._checked_at < IGNORE_RULES_CHECK_INTERVAL
+        ):
+            return
+
+        # 后台刷新，不阻塞当前请求
+        if not self._flight.in_flight("refresh"):
+            run_in_background(self.refresh(), "ignore rules refresh")
+
+    def match(self, application: str = "", module: str = "", user_agent: str = "") -> Optional[str]:
+        """
+        命中忽略规则时返回命中的字段名，否则返回 None
+        """
+        rules = self._rules
+        if application and application in rules["application"]:
+            return "application"
+        if module and module in rules["module"]:
+            return "module"
+        if user_agent and user_agent in rules["user_agent"]:
+            return "user_agent"
+        return None
+
+
+ignore_rules = IgnoreRules()
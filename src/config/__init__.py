@@ -1,3 +1,4 @@
+from functools import lru_cache
 from pydantic_settings import BaseSettings
 
 
@@ -7,6 +8,12 @@ class Settings(BaseSettings):
     database_port: int
     database_user: str
     database_passwd: str
+    database_max_workers: int = 8
+    database_pool: bool = True
+    database_max_connections: int = 16
+    database_stale_timeout: int = 3600  # 连接最长存活时间，超过后回收重建
+    database_idle_timeout: int = 300  # 池中闲置超过这个时间的连接直接关闭
+    database_pool_timeout: int = 10  # 等待空闲连接的最长时间
 
     afdian_query_order_api: str
     afdian_user_id: str
@@ -26,13 +33,48 @@ class Settings(BaseSettings):
 
     cdk_validate_api: str
 
+    webhook_outbox: bool = True  # webhook 先写 outbox 就应答，后台处理
+    webhook_workers: int = 4  # 同时处理的 webhook 数
+    webhook_max_attempts: int = 8  # 超过后不再重试，标记为 dead
+
     check_in_secret: str
+    check_in_buffered: bool = False  # 先进内存队列就返回，后台批量写库
+    check_in_buffer_size: int = 10000
+    check_in_flush_size: int = 500
+    check_in_flush_interval: float = 1  # seconds
+    check_in_enqueue_timeout: float = 1  # seconds，队列满时最多等这么久
     revenue_all_secret: str
+    revenue_cache_max_entries: int = 1024
+    revenue_cache_max_bytes: int = 256 * 1024 * 1024  # 估算值
+    revenue_snapshot_dir: str = "snapshots/revenue"  # 已结束月份的快照目录，留空不写快照
+
+    cache_backend: str = "memory"  # memory: 每个 worker 各一份；redis: 多个 worker 共享
+    cache_redis_url: str = "redis://127.0.0.1:6379/0"
 
     exception_notify_url: str
 
+    http_connect_timeout: float = 5  # seconds，包含等待连接池的时间
+    http_read_timeout: float = 30  # seconds
+    http_keepalive_timeout: float = 30  # seconds
+    # 每个上游的最大连接数
+    http_cdk_limit: int = 32
+    http_afdian_limit: int = 8
+    http_yimapay_limit: int = 8
+    http_notify_limit: int = 4
+
     class Config:
         env_file = ".env"
 
 
-settings = Settings()
+@lru_cache
+def get_settings() -> Settings:
+    return Settings()
+
+
+class LazySettings:
+    # 第一次访问配置时才去读 .env，import 本身不读
+    def __getattr__(self, name):
+        return getattr(get_settings(), name)
+
+
+settings = LazySettings()
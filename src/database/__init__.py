@@ -1,13 +1,22 @@
+import asyncio
+import heapq
+import pymysql
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from loguru import logger
 from peewee import (
+    DatabaseProxy,
     MySQLDatabase,
     CompositeKey,
     Model,
     CharField,
     TextField,
     DateTimeField,
+    DecimalField,
     IntegerField,
 )
+from playhouse.pool import PooledMySQLDatabase
 from playhouse.shortcuts import ReconnectMixin
 
 from src.config import settings
@@ -17,18 +26,145 @@ class ReconnectMySQLDatabase(ReconnectMixin, MySQLDatabase):
     pass
 
 
-db = ReconnectMySQLDatabase(
-    database=settings.database,
-    host=settings.database_host,
-    port=settings.database_port,
-    user=settings.database_user,
-    password=settings.database_passwd,
-    charset="utf8mb4",
-)
-
-if not db.connect():
-    logger.error("Database connection failed")
-    raise ValueError("Database connection failed")
+class ReconnectPooledMySQLDatabase(ReconnectMixin, PooledMySQLDatabase):
+    """
+    连接池：checkout 时 ping 掉断开的连接，超过 stale_timeout 的连接回收重建，
+    在池里闲置超过 idle_timeout 的连接直接关掉。
+    """
+
+    def __init__(self, database, idle_timeout=None, **kwargs):
+        self._idle_timeout = idle_timeout
+        self._returned_at = {}
+        super().__init__(database, **kwargs)
+
+    def _connect(self):
+        with self._pool_lock:
+            self._close_idle()
+            conn = super()._connect()
+            # 被取走或者被丢弃的连接不用再记录归还时间
+            pooled = {self.conn_key(entry[-1]) for entry in self._connections}
+            self._returned_at = {
+                key: ts for key, ts in self._returned_at.items() if key in pooled
+            }
+            return conn
+
+    def _close(self, conn, close_conn=False):
+        with self._pool_lock:
+            super()._close(conn, close_conn)
+            if any(entry[-1] is conn for entry in self._connections):
+                self._returned_at[self.conn_key(conn)] = time.time()
+
+    def _close_idle(self):
+        if not self._idle_timeout:
+            return
+
+        now = time.time()
+        keep = []
+        for entry in self._connections:
+            conn = entry[-1]
+            key = self.conn_key(conn)
+            if now - self._returned_at.get(key, now) > self._idle_timeout:
+                logger.debug(f"close idle connection: {key}")
+                self._returned_at.pop(key, None)
+                self._close_raw(conn)
+            else:
+                keep.append(entry)
+
+        if len(keep) != len(self._connections):
+            heapq.heapify(keep)
+            self._connections = keep
+
+
+db = DatabaseProxy()
+db_executor: ThreadPoolExecutor = None
+
+
+def init_database():
+    """
+    连接数据库并初始化执行线程池，在 lifespan 里调用，import 时不连库
+    """
+    global db_executor
+
+    if settings.database_pool:
+        database = ReconnectPooledMySQLDatabase(
+            database=settings.database,
+            host=settings.database_host,
+            port=settings.database_port,
+            user=settings.database_user,
+            password=settings.database_passwd,
+            charset="utf8mb4",
+            max_connections=settings.database_max_connections,
+            stale_timeout=settings.database_stale_timeout,
+            idle_timeout=settings.database_idle_timeout,
+            timeout=settings.database_pool_timeout,
+        )
+    else:
+        database = ReconnectMySQLDatabase(
+            database=settings.database,
+            host=settings.database_host,
+            port=settings.database_port,
+            user=settings.database_user,
+            password=settings.database_passwd,
+            charset="utf8mb4",
+        )
+
+    db.initialize(database)
+
+    if not db.connect():
+        logger.error("Database connection failed")
+        raise ValueError("Database connection failed")
+    db.close()
+
+    # peewee/pymysql 都是阻塞调用，统一丢到有界线程池里跑，避免卡住 event loop
+    db_executor = ThreadPoolExecutor(
+        max_workers=settings.database_max_workers, thread_name_prefix="db"
+    )
+
+
+def close_database():
+    global db_executor
+
+    if db_executor:
+        db_executor.shutdown(wait=True)
+        db_executor = None
+
+    if isinstance(db.obj, ReconnectPooledMySQLDatabase):
+        db.close_all()
+    elif db.obj:
+        db.close()
+
+
+def _call_with_connection(func, *args, **kwargs):
+    # 连接池模式下每次调用从池里取一个连接，用完归还
+    with db.connection_context():
+        return func(*args, **kwargs)
+
+
+async def run_in_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    if settings.database_pool:
+        call = partial(_call_with_connection, func, *args, **kwargs)
+    else:
+        call = partial(func, *args, **kwargs)
+    return await loop.run_in_executor(db_executor, call)
+
+
+def iter_rows(query):
+    """
+    逐行返回查询结果（tuple），MySQL 下用 SSCursor 从服务端流式读取，
+    不会把整个结果集先拉到内存里。需要在 db 线程里调用并且迭代完。
+    """
+    if not isinstance(db.obj, MySQLDatabase):
+        yield from query.tuples().iterator()
+        return
+
+    sql, params = query.sql()
+    cursor = db.connection().cursor(pymysql.cursors.SSCursor)
+    try:
+        cursor.execute(sql, params)
+        yield from cursor
+    finally:
+        cursor.close()
 
 
 class Plan(Model):
@@ -72,10 +208,19 @@ class Bill(Model):
 
     transferred = IntegerField(default=0)
 
+    # 正在获取 cdk 的 worker 写入的时间，防止并发重复获取
+    claimed_at = DateTimeField(null=True)
+
     class Meta:
         database = db
         table_name = "bill"
         primary_key = CompositeKey("platform", "order_id")
+        indexes = (
+            (("cdk", "expired_at"), False),
+            (("custom_order_id",), False),
+            # 主键是 (platform, order_id)，只按 order_id 查时用不上
+            (("order_id",), False),
+        )
 
 
 class CheckIn(Model):
@@ -88,6 +233,12 @@ class CheckIn(Model):
     class Meta:
         database = db
         table_name = "checkin"
+        indexes = (
+            (("cdk",), False),
+            (("activated_at",), False),
+            (("application", "activated_at"), False),
+            (("user_agent", "activated_at"), False),
+        )
 
 class IgnoreCheckIn(Model):
     application = CharField()
@@ -134,11 +285,81 @@ class Reward(Model):
     class Meta:
         database = db
         table_name = "reward"
+        indexes = ((("reward_key",), False),)
+
+
+class RevenueRollup(Model):
+    # 按 (月份, 应用, UA, 平台, 套餐) 汇总的收入，随 check_in / bill 变化增量更新
+    rollup_key = CharField(max_length=40, unique=True)  # 上面几个维度的 sha1
+
+    month = CharField(max_length=6)  # YYYYMM
+    application = CharField()
+    user_agent = CharField()
+    platform = CharField()
+    plan_id = CharField()
+
+    count = IntegerField(default=0)
+    buy_count = IntegerField(default=0)
+    amount = DecimalField(max_digits=16, decimal_places=2, default=0)
+
+    class Meta:
+        database = db
+        table_name = "revenue_rollup"
+        indexes = (
+            (("month", "application"), False),
+            (("month", "user_agent"), False),
+        )
 
 
-Plan.create_table()
-Bill.create_table()
-CheckIn.create_table()
-IgnoreCheckIn.create_table()
-Transaction.create_table()
-Reward.create_table()
+class RevenueRollupMonth(Model):
+    # 已经从明细全量重算过的月份，只有这些月份的汇总是完整的
+    month = CharField(max_length=6, primary_key=True)  # YYYYMM
+    backfilled_at = DateTimeField()
+
+    class Meta:
+        database = db
+        table_name = "revenue_rollup_month"
+
+
+class WebhookOutbox(Model):
+    # 收到的 webhook 先落库再应答，后台 worker 慢慢处理
+    PENDING = 0
+    DONE = 1
+    DEAD = -1
+
+    platform = CharField()
+    order_id = CharField()
+    payload = TextField()  # JSON
+
+    status = IntegerField(default=PENDING)
+    attempts = IntegerField(default=0)
+    next_attempt_at = DateTimeField()
+    claimed_at = DateTimeField(null=True)  # 正在处理的 worker 写入的时间
+    last_error = TextField(default="")
+
+    created_at = DateTimeField()
+    updated_at = DateTimeField()
+
+    class Meta:
+        database = db
+        table_name = "webhook_outbox"
+        indexes = ((("status", "next_attempt_at"), False),)
+
+
+def init_schema():
+    from .migrations import run_migrations
+
+    db.create_tables(
+        [
+            Plan,
+            Bill,
+            CheckIn,
+            IgnoreCheckIn,
+            Transaction,
+            Reward,
+            RevenueRollup,
+            RevenueRollupMonth,
+            WebhookOutbox,
+        ]
+    )
+    run_migrations()
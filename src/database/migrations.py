@@ -0,0 +1,173 @@
+import sys
+from datetime import datetime
+from loguru import logger
+from peewee import Model, IntegerField, CharField, DateTimeField
+from playhouse.migrate import MySQLMigrator, migrate
+
+from . import db, init_database, Bill, CheckIn, Reward, WebhookOutbox
+
+
+MIGRATION_LOCK = "billing_schema_migration"
+MIGRATION_LOCK_TIMEOUT = 60  # seconds，每等这么久打一次日志，一直等到拿到锁
+
+
+class SchemaVersion(Model):
+    version = IntegerField(primary_key=True)
+    description = CharField()
+    applied_at = DateTimeField()
+
+    class Meta:
+        database = db
+        table_name = "schema_version"
+
+
+def ensure_indexes(model) -> list:
+    """
+    把 model Meta.indexes 里声明的索引补到已有的表上，已经存在的（按列匹配）跳过。
+    create_table() 只在建表时建索引，老库需要靠这里补。
+    """
+    table = model._meta.table_name
+    existing = {tuple(index.columns) for index in db.get_indexes(table)}
+
+    migrator = MySQLMigrator(db)
+    created = []
+    for field_names, unique in model._meta.indexes:
+        columns = [model._meta.fields[name].column_name for name in field_names]
+        if tuple(columns) in existing:
+            continue
+
+        logger.info(f"create index, table: {table}, columns: {columns}, unique: {unique}")
+        migrate(migrator.add_index(table, columns, unique))
+        created.append(columns)
+
+    return created
+
+
+def add_hot_path_indexes():
+    for model in (Bill, CheckIn, Reward):
+        ensure_indexes(model)
+
+
+def add_bill_claimed_at():
+    # 新库 create_tables 时已经建好了
+    if "claimed_at" in {column.name for column in db.get_columns("bill")}:
+        return
+
+    migrator = MySQLMigrator(db)
+    migrate(migrator.add_column("bill", "claimed_at", Bill.claimed_at))
+
+
+# (version, description, func)，只能往后追加，不要修改已经发布的条目
+MIGRATIONS = [
+    (1, "add hot path indexes", add_hot_path_indexes),
+    (2, "add bill order_id index", lambda: ensure_indexes(Bill)),
+    (3, "add bill claimed_at", add_bill_claimed_at),
+]
+
+
+def run_migrations():
+    SchemaVersion.create_table()
+
+    # 多个 worker 同时启动时只让一个跑迁移，其他的等它跑完（大表加索引可能要很久），
+    # 拿到锁后已经应用过的版本会被跳过
+    while not db.execute_sql(
+        "SELECT GET_LOCK(%s, %s)", (MIGRATION_LOCK, MIGRATION_LOCK_TIMEOUT)
+    ).fetchone()[0]:
+        logger.warning(f"waiting for migration lock: {MIGRATION_LOCK}")
+
+    try:
+        applied = {row.version for row in SchemaVersion.select(SchemaVersion.version)}
+        for version, description, func in MIGRATIONS:
+            if version in applied:
+                continue
+
+            logger.info(f"apply migration, version: {version}, description: {description}")
+            func()
+            SchemaVersion.create(
+                version=version, description=description, applied_at=datetime.now()
+            )
+            logger.success(f"migration applied, version: {version}")
+    finally:
+        db.execute_sql("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK,))
+
+
+def hot_queries() -> dict:
+    now = datetime.now()
+    return {
+        "order_by_order_id": Bill.select().where(Bill.order_id == "")
+        + Bill.select().where(Bill.custom_order_id == ""),
+        "order_by_custom_order_id": Bill.select().where(Bill.custom_order_id == ""),
+        "latest_bill_by_cdk": Bill.select()
+        .where(Bill.cdk == "")
+        .order_by(Bill.expired_at.desc())
+        .limit(1),
+        "checkin_by_cdk": CheckIn.select().where(CheckIn.cdk == ""),
+        "revenue_checkins_all": CheckIn.select().where(
+            CheckIn.activated_at.between(now, now)
+        ),
+        "revenue_checkins_application": CheckIn.select().where(
+            CheckIn.application == "", CheckIn.activated_at.between(now, now)
+        ),
+        "revenue_checkins_user_agent": CheckIn.select().where(
+            CheckIn.user_agent == "", CheckIn.activated_at.between(now, now)
+        ),
+        "revenue_join": CheckIn.select(CheckIn.activated_at, Bill.actually_paid)
+        .join(Bill, on=(Bill.cdk == CheckIn.cdk))
+        .where(
+            CheckIn.application == "",
+            CheckIn.activated_at.between(now, now),
+            Bill.transferred >= 0,
+        )
+        .order_by(CheckIn.activated_at, CheckIn.id),
+        "reward_by_key": Reward.select().where(Reward.reward_key == ""),
+        "webhook_outbox_due": WebhookOutbox.select()
+        .where(
+            WebhookOutbox.status == WebhookOutbox.PENDING,
+            WebhookOutbox.next_attempt_at <= now,
+        )
+        .order_by(WebhookOutbox.next_attempt_at)
+        .limit(10),
+    }
+
+
+def explain_hot_queries() -> dict:
+    """
+    对热点查询跑 EXPLAIN，返回 {name: [{table, type, key, rows}, ...]}，没走索引的打 warning。
+    """
+    report = {}
+    for name, query in hot_queries().items():
+        sql, params = query.sql()
+        cursor = db.execute_sql("EXPLAIN " + sql, params)
+        columns = [column[0] for column in cursor.description]
+
+        report[name] = []
+        for row in cursor.fetchall():
+            row = dict(zip(columns, row))
+            plan = {
+                "table": row.get("table"),
+                "type": row.get("type"),
+                "key": row.get("key"),
+                "rows": row.get("rows"),
+            }
+            report[name].append(plan)
+
+            if plan["key"]:
+                logger.info(f"explain {name}: {plan}")
+            else:
+                logger.warning(f"explain {name}: no index used, {plan}")
+
+    return report
+
+
+if __name__ == "__main__":
+    # python -m src.database.migrations [migrate|explain]
+    command = sys.argv[1] if len(sys.argv) > 1 else "migrate"
+    init_database()
+    with db.connection_context():
+        if command == "migrate":
+            run_migrations()
+        elif command == "explain":
+            explain_hot_queries()
+        else:
+            print(f"unknown command: {command}")
+            sys.exit(1)
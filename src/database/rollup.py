@@ -0,0 +1,219 @@
+import sys
+import hashlib
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from loguru import logger
+from peewee import fn, Cast, chunked
+
+from . import Bill, CheckIn, RevenueRollup, RevenueRollupMonth, db
+
+
+BACKFILL_CHUNK_SIZE = 500
+
+
+def add_month(month: datetime) -> datetime:
+    if month.month == 12:
+        return datetime(month.year + 1, 1, 1)
+    return datetime(month.year, month.month + 1, 1)
+
+
+def rollup_key(month: str, application: str, user_agent: str, platform: str, plan_id: str) -> str:
+    raw = "\x1f".join((month, application, user_agent, platform, plan_id))
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def parse_amount(amount) -> Decimal:
+    try:
+        return Decimal(str(amount))
+    except InvalidOperation:
+        logger.warning(f"invalid amount: {amount}")
+        return Decimal(0)
+
+
+def apply_deltas(deltas: dict):
+    """
+    deltas: {(month, application, user_agent, platform, plan_id): [count, buy_count, amount]}
+    用 INSERT ... ON DUPLICATE KEY UPDATE 累加到 revenue_rollup。
+    按维度排序依次加锁，并发事务之间顺序一致，不会互相死锁。
+    """
+    for dims, (count, buy_count, amount) in sorted(deltas.items()):
+        if not count:
+            continue
+
+        month, application, user_agent, platform, plan_id = dims
+        RevenueRollup.insert(
+            rollup_key=rollup_key(*dims),
+            month=month,
+            application=application,
+            user_agent=user_agent,
+            platform=platform,
+            plan_id=plan_id,
+            count=count,
+            buy_count=buy_count,
+            amount=amount,
+        ).on_conflict(
+            update={
+                RevenueRollup.count: RevenueRollup.count + count,
+                RevenueRollup.buy_count: RevenueRollup.buy_count + buy_count,
+                RevenueRollup.amount: RevenueRollup.amount + amount,
+            }
+        ).execute()
+
+
+def add_delta(deltas: dict, checkin, bill, sign: int):
+    dims = (
+        checkin.activated_at.strftime("%Y%m"),
+        checkin.application,
+        checkin.user_agent,
+        bill.platform,
+        bill.plan_id,
+    )
+    delta = deltas.setdefault(dims, [0, 0, Decimal(0)])
+    delta[0] += sign
+    delta[1] += sign * bill.buy_count
+    delta[2] += sign * parse_amount(bill.actually_paid)
+
+
+def collect_checkin_deltas(deltas: dict, rows: list):
+    """
+    新写入的 check_in 行（dict），把它们 cdk 对应的有效订单的增量累计到 deltas
+    """
+    by_cdk = defaultdict(list)
+    for row in rows:
+        by_cdk[row["cdk"]].append(row)
+
+    bills = Bill.select(
+        Bill.cdk, Bill.platform, Bill.plan_id, Bill.buy_count, Bill.actually_paid
+    ).where(Bill.cdk << list(by_cdk), Bill.transferred >= 0)
+    for bill in bills:
+        for row in by_cdk[bill.cdk]:
+            add_delta(deltas, CheckIn(**row), bill, 1)
+
+
+def rollup_checkins(rows: list):
+    """
+    新写入的 check_in 行（dict），把它们 cdk 对应的有效订单计入汇总。
+    需要和写 check_in 在同一个事务里调用。
+    """
+    deltas = {}
+    collect_checkin_deltas(deltas, rows)
+    apply_deltas(deltas)
+
+
+def rollup_bill(bill: Bill, sign: int):
+    """
+    订单拿到 cdk 时 sign=1，订单被转移（transferred 变成 -1）前 sign=-1，
+    按这个 cdk 已有的 check_in 增减汇总。
+    """
+    if not bill.cdk:
+        return
+
+    deltas = {}
+    checkins = CheckIn.select(
+        CheckIn.activated_at, CheckIn.application, CheckIn.user_agent
+    ).where(CheckIn.cdk == bill.cdk)
+    for checkin in checkins:
+        add_delta(deltas, checkin, bill, sign)
+
+    apply_deltas(deltas)
+
+
+def backfill_month(month: datetime):
+    """
+    从 checkin / bill 全量重算某个月的汇总，并记下这个月已经重算过，查询才会读它的汇总。
+    当月还在被增量写入，重算前先锁住当月的 check_in 和汇总行，
+    让并发的增量等重算提交后再累加，否则会被 DELETE 冲掉或者重复计入。
+    """
+    cur_month = datetime(month.year, month.month, 1)
+    next_month = add_month(cur_month)
+    month_key = cur_month.strftime("%Y%m")
+    is_open = next_month > datetime.now()
+
+    query = (
+        CheckIn.select(
+            CheckIn.application,
+            CheckIn.user_agent,
+            Bill.platform,
+            Bill.plan_id,
+            fn.COUNT(CheckIn.id),
+            fn.SUM(Bill.buy_count),
+            fn.SUM(Cast(Bill.actually_paid, "DECIMAL(16, 2)")),
+        )
+        .join(Bill, on=(Bill.cdk == CheckIn.cdk))
+        .where(
+            CheckIn.activated_at >= cur_month,
+            CheckIn.activated_at < next_month,
+            Bill.transferred >= 0,
+        )
+        .group_by(CheckIn.application, CheckIn.user_agent, Bill.platform, Bill.plan_id)
+        .tuples()
+    )
+
+    with db.atomic():
+        if is_open:
+            # 先锁 check_in 再锁汇总行，和增量写入的加锁顺序一致；
+            # 锁住之后再读，拿到的是所有已提交增量之后的数据
+            CheckIn.select(fn.COUNT(CheckIn.id)).where(
+                CheckIn.activated_at >= cur_month, CheckIn.activated_at < next_month
+            ).for_update().scalar()
+            RevenueRollup.select(fn.COUNT(RevenueRollup.id)).where(
+                RevenueRollup.month == month_key
+            ).for_update().scalar()
+
+        rows = []
+        for application, user_agent, platform, plan_id, count, buy_count, amount in query:
+            dims = (month_key, application, user_agent, platform, plan_id)
+            rows.append(
+                {
+                    "rollup_key": rollup_key(*dims),
+                    "month": month_key,
+                    "application": application,
+                    "user_agent": user_agent,
+                    "platform": platform,
+                    "plan_id": plan_id,
+                    "count": count,
+                    "buy_count": buy_count or 0,
+                    "amount": amount or 0,
+                }
+            )
+
+        RevenueRollup.delete().where(RevenueRollup.month == month_key).execute()
+        for chunk in chunked(rows, BACKFILL_CHUNK_SIZE):
+            RevenueRollup.insert_many(chunk).execute()
+        RevenueRollupMonth.replace(month=month_key, backfilled_at=datetime.now()).execute()
+
+    logger.success(f"rollup backfilled, month: {month_key}, rows: {len(rows)}")
+
+
+def backfill(months: list = None):
+    """
+    不指定月份时只重算已经结束的月份，当月一直有增量写入，需要时显式指定
+    """
+    if not months:
+        first = CheckIn.select(fn.MIN(CheckIn.activated_at)).scalar()
+        if not first:
+            return
+
+        months = []
+        now = datetime.now()
+        cur, this_month = datetime(first.year, first.month, 1), datetime(now.year, now.month, 1)
+        while cur < this_month:
+            months.append(cur)
+            cur = add_month(cur)
+
+    for month in months:
+        backfill_month(month)
+
+
+if __name__ == "__main__":
+    # python -m src.database.rollup backfill [YYYYMM ...]
+    from . import init_database
+
+    if len(sys.argv) < 2 or sys.argv[1] != "backfill":
+        print("usage: python -m src.database.rollup backfill [YYYYMM ...]")
+        sys.exit(1)
+
+    init_database()
+    with db.connection_context():
+        backfill([datetime.strptime(month, "%Y%m") for month in sys.argv[2:]])
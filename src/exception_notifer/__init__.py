@@ -1,7 +1,7 @@
-from aiohttp import ClientSession
 from loguru import logger
 
 from src.config import settings
+from src.http_client import get_session
 
 
 async def exception_notify(module: str, error: Exception):
@@ -13,11 +13,10 @@ async def exception_notify(module: str, error: Exception):
     logger.debug(f"exception notify: {query_body}")
 
     try:
-        async with ClientSession() as session:
-            async with session.post(
-                settings.exception_notify_url, json=query_body
-            ) as response:
-                pass
+        async with get_session("notify").post(
+            settings.exception_notify_url, json=query_body
+        ) as response:
+            pass
     except Exception as e:
         logger.error(
             f"exception notify error: {e}, url: {settings.exception_notify_url}, query_body: {query_body}"
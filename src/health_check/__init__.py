@@ -1,8 +1,10 @@
 from fastapi import APIRouter
 
+from src.cache import cache_stats
+
 router = APIRouter()
 
 
 @router.get("/health")
 async def health_check():
-    return {"code": "0"}
+    return {"code": "0", "caches": cache_stats()}
@@ -0,0 +1,48 @@
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from loguru import logger
+
+from src.config import settings
+
+
+# 每个上游一个独立的连接池（bulkhead），爱发电慢了也占不到 CDK 后端的连接
+UPSTREAMS = ("cdk", "afdian", "yimapay", "notify")
+
+_sessions: dict[str, ClientSession] = {}
+
+
+def _limit(upstream: str) -> int:
+    return getattr(settings, f"http_{upstream}_limit")
+
+
+def get_session(upstream: str) -> ClientSession:
+    """
+    取某个上游的共享 ClientSession，第一次用时在当前 event loop 里创建。
+    """
+    if upstream not in UPSTREAMS:
+        raise ValueError(f"unknown upstream: {upstream}")
+
+    session = _sessions.get(upstream)
+    if session is None or session.closed:
+        connector = TCPConnector(
+            limit=_limit(upstream),
+            limit_per_host=_limit(upstream),
+            keepalive_timeout=settings.http_keepalive_timeout,
+        )
+        # connect 包含等待池里空闲连接的时间
+        timeout = ClientTimeout(
+            connect=settings.http_connect_timeout,
+            sock_read=settings.http_read_timeout,
+        )
+        session = ClientSession(connector=connector, timeout=timeout)
+        _sessions[upstream] = session
+        logger.debug(f"http session created, upstream: {upstream}, limit: {_limit(upstream)}")
+
+    return session
+
+
+async def close_sessions():
+    for upstream, session in list(_sessions.items()):
+        if not session.closed:
+            await session.close()
+        logger.debug(f"http session closed, upstream: {upstream}")
+    _sessions.clear()
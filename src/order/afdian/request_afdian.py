@@ -1,4 +1,3 @@
-from aiohttp import ClientSession
 from loguru import logger
 import json
 import time
@@ -6,6 +5,7 @@ import hashlib
 import asyncio
 
 from src.config import settings
+from src.http_client import get_session
 from src.exception_notifer import exception_notify
 
 
@@ -33,11 +33,10 @@ async def query(url: str, params: dict) -> dict:
 
     for i in range(1, 4):
         try:
-            async with ClientSession() as session:
-                async with session.post(url, json=query_body) as response:
-                    response = await response.json()
-                    logger.debug(f"url: {url}, params: {params}, response: {response}")
-                    return response
+            async with get_session("afdian").post(url, json=query_body) as response:
+                response = await response.json()
+                logger.debug(f"url: {url}, params: {params}, response: {response}")
+                return response
         except Exception as e:
             logger.error(f"url: {url}, params: {params}, query error: {e}")
             await exception_notify("爱发电", e)
@@ -2,6 +2,9 @@ from loguru import logger
 from fastapi import APIRouter
 
 from src.config import settings
+from src.database import run_in_db
+from src.order.outbox import enqueue_webhook, webhook_worker
+from src.order.resolver import invalidate_orders
 from .factory import process_afdian_order
 
 router = APIRouter()
@@ -24,6 +27,20 @@ async def afdian_webhook(webhook_body: dict):
         )
         return {"ec": 200, "em": "Test success"}
 
+    # 订单状态可能变了，之前"查不到"的结果作废
+    invalidate_orders(out_trade_no)
+
+    if settings.webhook_outbox:
+        try:
+            await run_in_db(enqueue_webhook, "afdian", out_trade_no, webhook_body)
+        except Exception as e:
+            logger.error(f"Enqueue webhook failed, out_trade_no: {out_trade_no}, error: {e}")
+            return {"ec": 500, "em": "Enqueue webhook failed"}
+
+        webhook_worker.wake()
+        logger.success(f"Webhook accepted, out_trade_no: {out_trade_no}")
+        return {"ec": 200, "em": "Accepted"}
+
     success, message = await process_afdian_order(out_trade_no)
     if not success:
         logger.error(
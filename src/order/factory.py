@@ -3,8 +3,19 @@ from typing import Tuple, Any
 from loguru import logger
 from datetime import datetime, timedelta
 
-from src.database import Bill, Plan
+from src.cache import SingleFlight
+from src.database import Bill, db, run_in_db
+from src.database.rollup import rollup_bill
+from src.plan_catalog import plan_catalog
 from src.cdk.acquire_cdk import acquire_cdk
+from .resolver import invalidate_orders
+from .waiter import order_waiters
+
+
+CLAIM_TIMEOUT = 120  # seconds，持有 claim 的 worker 挂掉后，超过这个时间别人可以接手
+
+# 同进程里同一个订单的并发处理合并成一次
+order_flight = SingleFlight()
 
 
 @dataclass
@@ -22,8 +33,18 @@ class OrderData:
 
 
 async def process_order(order_data: OrderData) -> Tuple[Any, str]:
+    """
+    webhook、/order/query 的上游查询、重试可能同时处理同一个订单，
+    同进程内合并成一次；跨进程靠 bill.claimed_at 保证只有一个去获取 cdk
+    """
+    key = (order_data.platform, order_data.platform_trade_no)
+    return await order_flight.do(key, _process_order, order_data)
+
+
+async def _process_order(order_data: OrderData) -> Tuple[Any, str]:
     try:
-        bill, created = Bill.get_or_create(
+        bill, created = await run_in_db(
+            Bill.get_or_create,
             platform=order_data.platform,
             order_id=order_data.platform_trade_no,
             defaults={
@@ -52,43 +73,127 @@ async def process_order(order_data: OrderData) -> Tuple[Any, str]:
         return None, "CDK already exists"
 
     try:
-        plan = Plan.get(
-            Plan.platform == order_data.platform, Plan.plan_id == order_data.plan_id
-        )
-        logger.info(
-            f"Plan found, out_trade_no: {order_data.platform_trade_no}, \
-plan: {plan}, title: {plan.title}, valid_days: {plan.valid_days}"
-        )
+        plan = await plan_catalog.get(order_data.platform, order_data.plan_id)
     except Exception as e:
         logger.error(
             f"Plan not found, out_trade_no: {order_data.platform_trade_no}, error: {e}"
         )
         return None, "Plan not found"
 
+    if not plan:
+        logger.error(
+            f"Plan not found, out_trade_no: {order_data.platform_trade_no}, plan_id: {order_data.plan_id}"
+        )
+        return None, "Plan not found"
+
+    logger.info(
+        f"Plan found, out_trade_no: {order_data.platform_trade_no}, \
+plan: {plan}, title: {plan.title}, valid_days: {plan.valid_days}"
+    )
+
     delta = timedelta(days=plan.valid_days * order_data.buy_count)
 
     expired = datetime.now() + delta
-    cdk = await acquire_cdk(expired, plan.app_group)
 
     try:
-        bill = Bill.get(
-            Bill.platform == order_data.platform,
-            Bill.order_id == order_data.platform_trade_no,
-        )
-        bill.cdk = cdk
-        bill.expired_at = expired
-        bill.save()
+        claimed = await run_in_db(claim_bill, bill)
     except Exception as e:
         logger.error(
-            f"Update bill failed, out_trade_no: {order_data.platform_trade_no}, error: {e}"
+            f"Claim bill failed, out_trade_no: {order_data.platform_trade_no}, error: {e}"
         )
-        return None, "Update bill failed"
+        return None, "Claim bill failed"
 
+    if not claimed:
+        logger.warning(
+            f"Bill is being processed or CDK already exists, out_trade_no: {order_data.platform_trade_no}"
+        )
+        return None, "Order is being processed"
+
+    cdk = await acquire_cdk(expired, plan.app_group)
     if not cdk:
         logger.error(f"Query CDK failed, out_trade_no: {order_data.platform_trade_no}")
+        await release_bill(bill)
         return None, "Query CDK failed"
 
+    try:
+        saved = await run_in_db(save_bill_cdk, bill, cdk, expired)
+    except Exception as e:
+        logger.error(
+            f"Update bill failed, out_trade_no: {order_data.platform_trade_no}, cdk: {cdk}, error: {e}"
+        )
+        await release_bill(bill)
+        return None, "Update bill failed"
+
+    if not saved:
+        # 有 claim 的情况下不应该发生，这个 cdk 浪费了
+        logger.error(
+            f"CDK already exists, out_trade_no: {order_data.platform_trade_no}, wasted cdk: {cdk}"
+        )
+        return None, "CDK already exists"
+
+    invalidate_orders(order_data.platform_trade_no, order_data.custom_order_id)
+    order_waiters.notify(order_data.platform_trade_no, order_data.custom_order_id)
+
     logger.success(
         f"Process order success, out_trade_no: {order_data.platform_trade_no}"
     )
     return bill, "OK"
+
+
+def unassigned(bill: Bill):
+    """
+    条件：还是这个订单，并且还没有 cdk
+    """
+    return (
+        (Bill.platform == bill.platform)
+        & (Bill.order_id == bill.order_id)
+        & ((Bill.cdk == "") | Bill.cdk.is_null())
+    )
+
+
+def claim_bill(bill: Bill) -> bool:
+    """
+    UPDATE ... WHERE cdk = '' AND 没有别人持有 claim，只有更新成功的一方去获取 cdk
+    """
+    now = datetime.now()
+    expired_claim = now - timedelta(seconds=CLAIM_TIMEOUT)
+    updated = (
+        Bill.update(claimed_at=now)
+        .where(
+            unassigned(bill),
+            Bill.claimed_at.is_null() | (Bill.claimed_at < expired_claim),
+        )
+        .execute()
+    )
+    return updated == 1
+
+
+async def release_bill(bill: Bill):
+    try:
+        await run_in_db(
+            Bill.update(claimed_at=None).where(unassigned(bill)).execute
+        )
+    except Exception as e:
+        # 释放失败也没关系，claim 过期后会被别人接手
+        logger.error(f"Release bill failed, out_trade_no: {bill.order_id}, error: {e}")
+
+
+def save_bill_cdk(bill: Bill, cdk: str, expired: datetime) -> bool:
+    """
+    只有 cdk 还是空的时候才写入，返回是否写入成功
+    """
+    with db.atomic():
+        updated = (
+            Bill.update(cdk=cdk, expired_at=expired, claimed_at=None)
+            .where(unassigned(bill))
+            .execute()
+        )
+        if updated != 1:
+            return False
+
+        bill.cdk = cdk
+        bill.expired_at = expired
+        bill.claimed_at = None
+        rollup_bill(bill, 1)
+
+    return True
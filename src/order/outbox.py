@@ -0,0 +1,215 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+from typing import Any, Optional, Tuple
+from loguru import logger
+
+from src.config import settings
+from src.database import WebhookOutbox, run_in_db
+from src.exception_notifer import exception_notify
+from .factory import process_order
+from .afdian.factory import process_afdian_order
+from .yimapay.factory import parse_yimapay_data
+
+
+POLL_INTERVAL = 1  # seconds，没有被唤醒时多久查一次库，别的 worker 进程收到的 webhook 靠这个
+CLAIM_TIMEOUT = 300  # seconds，处理中的 worker 挂掉后，超过这个时间别人可以接手
+CLAIM_BATCH = 10  # 每次查出来抢的候选行数
+RETRY_BASE = 5  # seconds，第 n 次失败后等 RETRY_BASE * 2^(n-1)
+RETRY_MAX = 3600  # seconds
+STOP_TIMEOUT = 10  # seconds，关闭时等正在处理的 webhook 的最长时间
+
+# 重试也是这个结果，不用再处理了
+DONE_MESSAGES = {"CDK already exists"}
+# 重试也不会成功，直接进死信
+DEAD_MESSAGES = {"not an order", "Product type not supported", "Parse order data failed"}
+
+
+def enqueue_webhook(platform: str, order_id: str, payload: dict) -> int:
+    now = datetime.now()
+    return WebhookOutbox.insert(
+        platform=platform,
+        order_id=order_id,
+        payload=json.dumps(payload, ensure_ascii=False),
+        next_attempt_at=now,
+        created_at=now,
+        updated_at=now,
+    ).execute()
+
+
+def claim_next() -> Optional[WebhookOutbox]:
+    """
+    找一条到期的 webhook，用条件 UPDATE 抢到 claim 才返回，多个进程不会重复处理
+    """
+    # DATETIME 不存微秒，去掉后面才能按 claimed_at 比较
+    now = datetime.now().replace(microsecond=0)
+    free = WebhookOutbox.claimed_at.is_null() | (
+        WebhookOutbox.claimed_at < now - timedelta(seconds=CLAIM_TIMEOUT)
+    )
+
+    candidates = (
+        WebhookOutbox.select()
+        .where(
+            WebhookOutbox.status == WebhookOutbox.PENDING,
+            WebhookOutbox.next_attempt_at <= now,
+            free,
+        )
+        .order_by(WebhookOutbox.next_attempt_at)
+        .limit(CLAIM_BATCH)
+    )
+    for row in candidates:
+        updated = (
+            WebhookOutbox.update(claimed_at=now)
+            .where(
+                WebhookOutbox.id == row.id,
+                WebhookOutbox.status == WebhookOutbox.PENDING,
+                free,
+            )
+            .execute()
+        )
+        if updated == 1:
+            row.claimed_at = now
+            return row
+
+    return None
+
+
+def record_result(row: WebhookOutbox, status: int, error: str = "") -> bool:
+    """
+    写回处理结果并释放 claim。claim 已经被别人接手的话不覆盖，返回 False
+    """
+    now = datetime.now()
+    attempts = row.attempts + 1
+
+    next_attempt_at = row.next_attempt_at
+    if status == WebhookOutbox.PENDING:
+        if attempts >= settings.webhook_max_attempts:
+            status = WebhookOutbox.DEAD
+        else:
+            delay = min(RETRY_BASE * 2 ** (attempts - 1), RETRY_MAX)
+            next_attempt_at = now + timedelta(seconds=delay)
+
+    updated = (
+        WebhookOutbox.update(
+            status=status,
+            attempts=attempts,
+            next_attempt_at=next_attempt_at,
+            claimed_at=None,
+            last_error=error,
+            updated_at=now,
+        )
+        .where(WebhookOutbox.id == row.id, WebhookOutbox.claimed_at == row.claimed_at)
+        .execute()
+    )
+
+    row.status, row.attempts, row.next_attempt_at = status, attempts, next_attempt_at
+    return updated == 1
+
+
+async def process_webhook(row: WebhookOutbox) -> Tuple[Any, str]:
+    payload = json.loads(row.payload)
+
+    if row.platform == "afdian":
+        return await process_afdian_order(row.order_id)
+
+    if row.platform == "yimapay":
+        order_data = parse_yimapay_data(payload, payload)
+        if not order_data:
+            return None, "Parse order data failed"
+        return await process_order(order_data)
+
+    return None, "not an order"
+
+
+class WebhookWorker:
+    """
+    从 outbox 里取 webhook 处理，settings.webhook_workers 个协程并发，
+    失败的按指数退避重试，超过 webhook_max_attempts 次进死信（status = DEAD）
+    """
+
+    def __init__(self):
+        self._tasks = []
+        self._wakeup: asyncio.Event = None
+        self._stopping = False
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._tasks = [
+            asyncio.create_task(self._run()) for _ in range(settings.webhook_workers)
+        ]
+        logger.info(f"webhook worker started, workers: {settings.webhook_workers}")
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stop(self):
+        if not self._tasks:
+            return
+
+        self._stopping = True
+        self._wakeup.set()
+        _, pending = await asyncio.wait(self._tasks, timeout=STOP_TIMEOUT)
+        # 没处理完的 claim 过期后会被重新处理
+        for task in pending:
+            task.cancel()
+        self._tasks = []
+        logger.info(f"webhook worker stopped, cancelled: {len(pending)}")
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                row = await run_in_db(claim_next)
+            except Exception as e:
+                logger.error(f"claim webhook failed, error: {e}")
+                row = None
+
+            if row is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._handle(row)
+
+    async def _handle(self, row: WebhookOutbox):
+        try:
+            bill, message = await process_webhook(row)
+        except Exception as e:
+            bill, message = None, f"{type(e).__name__}: {e}"
+
+        if bill or message in DONE_MESSAGES:
+            status = WebhookOutbox.DONE
+        elif message in DEAD_MESSAGES:
+            status = WebhookOutbox.DEAD
+        else:
+            status = WebhookOutbox.PENDING
+
+        try:
+            error = "" if status == WebhookOutbox.DONE else message
+            await run_in_db(record_result, row, status, error)
+        except Exception as e:
+            logger.error(f"record webhook result failed, id: {row.id}, error: {e}")
+            return
+
+        if row.status == WebhookOutbox.DONE:
+            logger.success(
+                f"webhook processed, id: {row.id}, platform: {row.platform}, order_id: {row.order_id}, message: {message}"
+            )
+        elif row.status == WebhookOutbox.DEAD:
+            logger.error(
+                f"webhook dead, id: {row.id}, platform: {row.platform}, order_id: {row.order_id}, attempts: {row.attempts}, message: {message}"
+            )
+            await exception_notify(
+                "Webhook", Exception(f"{row.platform} {row.order_id}: {message}")
+            )
+        else:
+            logger.warning(
+                f"webhook retry, id: {row.id}, platform: {row.platform}, order_id: {row.order_id}, attempts: {row.attempts}, next_attempt_at: {row.next_attempt_at}, message: {message}"
+            )
+
+
+webhook_worker = WebhookWorker()
@@ -1,25 +1,56 @@
 from loguru import logger
 from fastapi import APIRouter
 
-from src.database import Bill, Plan
+from src.cache import run_in_background
+from src.database import run_in_db
+from src.plan_catalog import plan_catalog
+from .resolver import (
+    resolve_bill,
+    get_cached_order,
+    cache_order,
+    order_generation,
+    fetch_upstream,
+    is_missing,
+)
+from .waiter import order_waiters
 from .yimapay.factory import process_yimapay_order
 from .afdian.factory import process_afdian_order
 
 router = APIRouter()
 
+WAIT_DEFAULT_TIMEOUT = 25  # seconds
+WAIT_MAX_TIMEOUT = 60  # seconds
+
+PENDING_RESPONSE = {"ec": 202, "code": 21003, "msg": "order pending"}
+
 
 @router.get("/order/query")
-async def query_order(order_id: str = None, custom_order_id: str = None, cdk: str = None):
+async def query_order(
+    order_id: str = None,
+    custom_order_id: str = None,
+    cdk: str = None,
+    pending: bool = False,
+):
+    """
+    pending=true 时库里没有的订单不等上游，后台去查并立刻返回 202，之后用 /order/wait 等结果
+    """
     # logger.debug(f"order_id: {order_id}, custom_order_id: {custom_order_id}")
     if order_id:
-        bill = Bill.get_or_none((Bill.order_id == order_id) | (Bill.custom_order_id == order_id))
+        key = ("order_id", order_id)
     elif custom_order_id:
-        bill = Bill.get_or_none(Bill.custom_order_id == custom_order_id)
+        key = ("custom_order_id", custom_order_id)
     elif cdk:
-        bill = Bill.select().where(Bill.cdk == cdk).order_by(Bill.expired_at.desc()).get_or_none()
+        key = ("cdk", cdk)
     else:
         return {"ec": 400, "code": 21001, "msg": "order_id is required"}
 
+    cached = get_cached_order(key)
+    if cached:
+        return cached
+
+    generation = order_generation()
+    bill = await run_in_db(resolve_bill, order_id, custom_order_id, cdk)
+
     if not bill:
         if not order_id:  # 通过 custom_order_id 来查的
             return {"ec": 404, "code": 21002, "msg": "order not found"}
@@ -27,41 +58,91 @@ async def query_order(order_id: str = None, custom_order_id: str = None, cdk: st
         logger.warning(
             f"Bill not found, order_id: {order_id}, try to query from Afdian/Yimapay"
         )
-        if len(order_id) == 22 and order_id.startswith("YMF"):
-            bill, message = await process_yimapay_order(order_id, "")
-        elif len(order_id) == 32 and order_id[:14].isdigit():
-            bill, message = await process_yimapay_order("", order_id)
-        elif len(order_id) == 27 and order_id.isdigit():
-            bill, message = await process_afdian_order(order_id)
-        else:
+        fetch = upstream_fetcher(order_id)
+        if not fetch:
             logger.error(f"Order not match and platform: {order_id}")
             return {"ec": 400, "code": 21001, "msg": "order_id not match"}
 
+        if pending:
+            if is_missing(order_id):
+                return {"ec": 404, "code": 21002, "msg": "order not found"}
+
+            run_in_background(
+                fetch_upstream(order_id, fetch), f"fetch upstream order {order_id}"
+            )
+            return PENDING_RESPONSE
+
+        bill, message = await fetch_upstream(order_id, fetch)
+
         if not bill:
             logger.error(f"Order not found: {order_id}, {message}")
             return {"ec": 404, "code": 21002, "msg": "order not found"}
 
+        # 重新查一次带上同 cdk 最晚的 expired_at
+        bill = await run_in_db(resolve_bill, bill.order_id)
+        if not bill:
+            logger.error(f"Bill not found after process, order_id: {order_id}")
+            return {"ec": 500, "code": 21000, "msg": "Unknow error, please contact us!"}
+
+    if pending and not bill.cdk:
+        # 订单已经入库，cdk 还在生成
+        return PENDING_RESPONSE
+
+    return await order_response(key, bill, generation)
+
+
+@router.get("/order/wait")
+async def wait_order(order_id: str, timeout: float = WAIT_DEFAULT_TIMEOUT):
+    """
+    长轮询：等到订单拿到 cdk 或者超时。order_id 可以是平台订单号或自定义订单号，
+    拿到了返回和 /order/query 一样的结果，超时返回 202
+    """
+    timeout = max(0, min(timeout, WAIT_MAX_TIMEOUT))
+    bill = None
+
+    async def check() -> bool:
+        nonlocal bill
+        bill = await run_in_db(resolve_bill, order_id)
+        return bool(bill and bill.cdk)
+
+    generation = order_generation()
+    if not await order_waiters.wait(order_id, timeout, check):
+        return PENDING_RESPONSE
+
+    return await order_response(("order_id", order_id), bill, generation)
+
+
+def upstream_fetcher(order_id: str):
+    """
+    按订单号的格式判断是哪个平台的，返回去上游查询的函数，认不出来返回 None
+    """
+    if len(order_id) == 22 and order_id.startswith("YMF"):
+        return lambda: process_yimapay_order(order_id, "")
+    if len(order_id) == 32 and order_id[:14].isdigit():
+        return lambda: process_yimapay_order("", order_id)
+    if len(order_id) == 27 and order_id.isdigit():
+        return lambda: process_afdian_order(order_id)
+    return None
+
+
+async def order_response(key, bill, generation: int) -> dict:
+    order_id = bill.order_id
+
     try:
-        plan = Plan.get(Plan.plan_id == bill.plan_id)
+        plan = await plan_catalog.get_by_plan_id(bill.plan_id)
     except Exception as e:
         logger.error(f"Plan not found, order_id: {order_id}, error: {e}")
         return {"ec": 500, "code": 21000, "msg": "Unknow error, please contact us!"}
 
-    if not bill.cdk:
-        logger.error(f"CDK not found, order_id: {order_id}")
+    if not plan:
+        logger.error(f"Plan not found, order_id: {order_id}, plan_id: {bill.plan_id}")
         return {"ec": 500, "code": 21000, "msg": "Unknow error, please contact us!"}
 
-    latest_bill = (
-        Bill.select()
-        .where(Bill.cdk == bill.cdk)
-        .order_by(Bill.expired_at.desc())
-        .get_or_none()
-    )
-    if not latest_bill:
-        logger.error(f"latest_bill not found, order_id: {order_id}")
+    if not bill.cdk:
+        logger.error(f"CDK not found, order_id: {order_id}")
         return {"ec": 500, "code": 21000, "msg": "Unknow error, please contact us!"}
 
-    return {
+    response = {
         "ec": 200,
         "code": 0,
         "msg": "Success",
@@ -73,7 +154,7 @@ async def query_order(order_id: str = None, custom_order_id: str = None, cdk: st
             "buy_count": bill.buy_count,
             "user_id": bill.user_id,
             "created_at": bill.created_at,
-            "expired_at": latest_bill.expired_at,
+            "expired_at": bill.latest_expired_at,
             "cdk": bill.cdk,
             "plan": {
                 "title": plan.title,
@@ -85,3 +166,5 @@ async def query_order(order_id: str = None, custom_order_id: str = None, cdk: st
             },
         },
     }
+    cache_order(key, response, generation)
+    return response
@@ -0,0 +1,113 @@
+from typing import Awaitable, Callable, Optional, Tuple, Any
+from peewee import fn
+
+from src.cache import TTLCache, SingleFlight
+from src.database import Bill
+
+
+ORDER_CACHE_SIZE = 4096
+ORDER_CACHE_TTL = 5  # seconds，客户端等支付时会高频轮询
+ORDER_MISSING_TTL = 10  # seconds，去上游也没查到的订单多久内不再查
+# 上游明确答复"没有这个订单 / 还没支付"时的错误信息（易码付的后面带着订单号，按前缀匹配）。
+# 网络错误、抢锁失败、写库失败等临时失败不在这里，下次请求还要去查
+MISSING_MESSAGES = (
+    "Order not found",  # 爱发电查不到
+    "Create order failed",  # 易码付 resultCode 不是 200
+    "Parse order data failed",  # 易码付订单还没支付成功
+)
+
+# (字段, 值) -> /order/query 的成功响应
+order_cache = TTLCache("order", ORDER_CACHE_SIZE)
+# order_id -> 上游确认不存在 / 未支付的原因
+order_missing_cache = TTLCache("order_missing", ORDER_CACHE_SIZE)
+# 同一个 order_id 同时只去上游查一次
+upstream_flight = SingleFlight()
+# 每次有订单写入加一，查询开始前后不一致的结果不缓存
+_generation = 0
+
+
+def invalidate_orders(*order_ids: str):
+    """
+    有订单写入（拿到 cdk、转移、续期）或者收到 webhook 后调用。
+    同一个 cdk 的其他订单的 expired_at 也会变，所以结果缓存直接全部清掉；
+    order_ids 是这次涉及的订单号，从未找到的缓存里去掉
+    """
+    global _generation
+    _generation += 1
+    order_cache.clear()
+    for order_id in order_ids:
+        if order_id:
+            order_missing_cache.delete(order_id)
+
+
+def order_generation() -> int:
+    return _generation
+
+
+def get_cached_order(key) -> Optional[dict]:
+    return order_cache.get(key)
+
+
+def cache_order(key, response: dict, generation: int):
+    if generation == _generation:
+        order_cache.set(key, response, ORDER_CACHE_TTL)
+
+
+def is_missing(order_id: str) -> bool:
+    return order_missing_cache.get(order_id) is not None
+
+
+async def fetch_upstream(
+    order_id: str, fetch: Callable[[], Awaitable[Tuple[Any, str]]]
+) -> Tuple[Any, str]:
+    """
+    库里没有的订单去爱发电/易码付查，并发的查询合并成一次，查不到的短时间内直接返回
+    """
+    message = order_missing_cache.get(order_id)
+    if message is not None:
+        return None, message
+
+    return await upstream_flight.do(order_id, _fetch_upstream, order_id, fetch)
+
+
+async def _fetch_upstream(order_id: str, fetch) -> Tuple[Any, str]:
+    generation = _generation
+    bill, message = await fetch()
+    # 查询期间来了 webhook 的话，这次的结果可能已经过时，不缓存
+    if not bill and generation == _generation and message.startswith(MISSING_MESSAGES):
+        order_missing_cache.set(order_id, message, ORDER_MISSING_TTL)
+    return bill, message
+
+
+def resolve_bill(
+    order_id: str = None, custom_order_id: str = None, cdk: str = None
+) -> Optional[Bill]:
+    """
+    一条 SQL 查出订单和同 cdk 下最晚的 expired_at（bill.latest_expired_at）。
+    order_id 既可能是平台订单号也可能是自定义订单号，用 UNION ALL 让两边各走各的索引，
+    不用 OR
+    """
+    latest = Bill.alias()
+    latest_expired_at = (
+        latest.select(fn.MAX(latest.expired_at))
+        .where(latest.cdk == Bill.cdk)
+        .alias("latest_expired_at")
+    )
+    select = Bill.select(Bill, latest_expired_at)
+
+    if order_id:
+        query = select.where(Bill.order_id == order_id) + select.where(
+            Bill.custom_order_id == order_id
+        )
+    elif custom_order_id:
+        query = select.where(Bill.custom_order_id == custom_order_id)
+    elif cdk:
+        query = select.where(Bill.cdk == cdk).order_by(Bill.expired_at.desc())
+    else:
+        return None
+
+    for bill in query.limit(1):
+        # 子查询的结果不经过字段转换，统一成 datetime
+        bill.latest_expired_at = Bill.expired_at.python_value(bill.latest_expired_at)
+        return bill
+    return None
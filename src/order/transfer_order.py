@@ -3,11 +3,15 @@ from fastapi import APIRouter, Query
 from datetime import datetime, timedelta
 
 from src.cdk.renew_cdk import renew_cdk
-from src.database import Bill, Plan, Transaction, Reward
+from src.database import Bill, Plan, Transaction, Reward, db, run_in_db
+from src.database.rollup import rollup_bill
+from .resolver import invalidate_orders
 
 router = APIRouter()
 
 CDK_LENGTH = 24
+# 下单超过这么多天（按整天算）的订单不允许合并
+TRANSFER_WINDOW_DAYS = 3
 
 @router.get("/order/transfer")
 async def transfer_order(_from: str = Query(..., alias="from"), to: str = None):
@@ -21,7 +25,9 @@ async def transfer_order(_from: str = Query(..., alias="from"), to: str = None):
         logger.error(f"bad to: {to}")
         return {"ec": 400, "msg": "bad to"}
 
-    to_bill = Bill.select().where(Bill.cdk == to).order_by(Bill.expired_at.desc()).get_or_none()
+    to_bill = await run_in_db(
+        Bill.select().where(Bill.cdk == to).order_by(Bill.expired_at.desc()).get_or_none
+    )
 
     if not to_bill:
         logger.error(f"cdk not found, to: {to}")
@@ -32,7 +38,9 @@ async def transfer_order(_from: str = Query(..., alias="from"), to: str = None):
         if reward:
             return reward
 
-    from_bill = Bill.select().where(Bill.cdk == _from).order_by(Bill.expired_at.desc()).get_or_none()
+    from_bill = await run_in_db(
+        Bill.select().where(Bill.cdk == _from).order_by(Bill.expired_at.desc()).get_or_none
+    )
     if not from_bill:
         logger.error(f"order not found, _from: {_from}")
         return {"ec": 400, "msg": "Order not found"}
@@ -40,7 +48,7 @@ async def transfer_order(_from: str = Query(..., alias="from"), to: str = None):
     now = datetime.now()
 
     # 超过3天的订单不允许合并
-    if (now - from_bill.created_at).days > 3:
+    if (now - from_bill.created_at).days > TRANSFER_WINDOW_DAYS:
         logger.error(f"order expired, _from: {_from}")
         return {
             "ec": 403,
@@ -65,9 +73,8 @@ async def transfer_order(_from: str = Query(..., alias="from"), to: str = None):
     transferred = from_bill.transferred
 
     # 方便查账，Bill 里搜这个 CDK 能找同时找到两条记录
-    from_bill.cdk = to_bill.cdk
-    from_bill.transferred = -1
-    from_bill.save()
+    await run_in_db(retire_bill, from_bill, to_bill.cdk)
+    invalidate_orders()
 
 
     if to_bill.expired_at > now:
@@ -78,9 +85,11 @@ async def transfer_order(_from: str = Query(..., alias="from"), to: str = None):
     to_bill.transferred += transferred + 1
 
     await renew_cdk(to_bill.cdk, to_bill.expired_at)
-    to_bill.save()
+    await run_in_db(to_bill.save)
+    invalidate_orders()
 
-    Transaction.create(
+    await run_in_db(
+        Transaction.create,
         from_platform=from_bill.platform,
         from_order_id=_from,
         to_platform=to_bill.platform,
@@ -97,8 +106,17 @@ async def transfer_order(_from: str = Query(..., alias="from"), to: str = None):
     return {"ec": 200, "msg": "Success"}
 
 
+def retire_bill(bill: Bill, new_cdk: str):
+    with db.atomic():
+        # transferred 变成 -1 后这笔订单不再计入收入
+        rollup_bill(bill, -1)
+        bill.cdk = new_cdk
+        bill.transferred = -1
+        bill.save()
+
+
 async def get_reward(_from: str, to_bill):
-    reward = Reward.get_or_none(Reward.reward_key == _from)
+    reward = await run_in_db(Reward.get_or_none, Reward.reward_key == _from)
     if not reward:
         return None
 
@@ -144,7 +162,8 @@ async def get_reward(_from: str, to_bill):
     delta = timedelta(days=reward.valid_days)
     new_expired_at = to_bill.expired_at + delta
 
-    _, created = Transaction.get_or_create(
+    _, created = await run_in_db(
+        Transaction.get_or_create,
         from_platform="reward",
         from_order_id=_from,
         to_platform=to_bill.platform,
@@ -162,11 +181,12 @@ async def get_reward(_from: str, to_bill):
 
     to_bill.expired_at = new_expired_at
     await renew_cdk(to_bill.cdk, to_bill.expired_at)
-    to_bill.save()
+    await run_in_db(to_bill.save)
+    invalidate_orders()
 
     reward.remaining -= 1
     reward.received_count += 1
-    reward.save()
+    await run_in_db(reward.save)
 
     logger.success(
         f"reward transferred, _from: {_from}, to: {to_bill.order_id}, delta: {delta}, new_expired_at: {to_bill.expired_at}"
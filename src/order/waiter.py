@@ -0,0 +1,57 @@
+import asyncio
+from collections import defaultdict
+from time import monotonic
+from typing import Awaitable, Callable
+
+
+WAIT_CHECK_INTERVAL = 2  # seconds，webhook 可能落在别的 worker 上，隔一段时间查一次库
+
+
+class OrderWaiters:
+    """
+    等订单拿到 cdk。同进程里 process_order 写完 cdk 后 notify，等待方立刻被唤醒
+    """
+
+    def __init__(self):
+        self._events = defaultdict(set)  # order_id -> 每个等待方一个 Event
+
+    def notify(self, *order_ids: str):
+        for order_id in order_ids:
+            for event in self._events.get(order_id, ()):
+                event.set()
+
+    async def wait(
+        self, order_id: str, timeout: float, check: Callable[[], Awaitable[bool]]
+    ) -> bool:
+        """
+        check() 返回 True 或者超时为止，返回最后一次 check 的结果
+        """
+        deadline = monotonic() + timeout
+        event = asyncio.Event()
+        # 先登记再检查，检查和登记之间的 notify 不会丢
+        self._events[order_id].add(event)
+        try:
+            while True:
+                if await check():
+                    return True
+
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+
+                try:
+                    await asyncio.wait_for(event.wait(), min(remaining, WAIT_CHECK_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+        finally:
+            events = self._events[order_id]
+            events.discard(event)
+            if not events:
+                del self._events[order_id]
+
+    def __len__(self):
+        return len(self._events)
+
+
+order_waiters = OrderWaiters()
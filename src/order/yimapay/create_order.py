@@ -5,7 +5,7 @@ from fastapi import APIRouter, HTTPException, Request
 from datetime import datetime
 import random
 
-from src.database import Plan
+from src.plan_catalog import plan_catalog
 from src.config import settings
 
 from .request_yimapay import query
@@ -32,11 +32,15 @@ async def create_order(pay: str, plan_id: str, request: Request):
         return {"ec": 400, "code": 21001, "msg": "Invalid pay"}
 
     try:
-        plan = Plan.get(Plan.platform == "yimapay", Plan.plan_id == plan_id)
+        plan = await plan_catalog.get("yimapay", plan_id)
     except Exception as e:
         logger.error(f"Plan not found, plan_id: {plan_id}, error: {e}")
         return {"ec": 404, "code": 21002, "msg": "Plan not found"}
 
+    if not plan:
+        logger.error(f"Plan not found, plan_id: {plan_id}")
+        return {"ec": 404, "code": 21002, "msg": "Plan not found"}
+
     custom_order_id = datetime.now().strftime("%Y%m%d%H%M%S") + "".join(
         random.SystemRandom().choices(string.ascii_lowercase + string.digits, k=18)
     )
@@ -1,9 +1,9 @@
-from aiohttp import ClientSession
 from loguru import logger
 import hashlib
 import asyncio
 
 from src.config import settings
+from src.http_client import get_session
 from src.exception_notifer import exception_notify
 
 def gen_sign(params: dict) -> str:
@@ -25,11 +25,10 @@ async def query(url: str, params: dict) -> dict:
 
     for i in range(1, 4):
         try:
-            async with ClientSession() as session:
-                async with session.post(url, params=params) as response:
-                    response = await response.json()
-                    logger.debug(f"url: {url}, params: {params}, response: {response}")
-                    return response
+            async with get_session("yimapay").post(url, params=params) as response:
+                response = await response.json()
+                logger.debug(f"url: {url}, params: {params}, response: {response}")
+                return response
         except Exception as e:
             logger.error(f"url: {url}, params: {params}, query error: {e}")
             await exception_notify("易码付", e)
@@ -2,7 +2,10 @@ from loguru import logger
 from fastapi import APIRouter, Request
 
 from src.config import settings
+from src.database import run_in_db
 from src.order.factory import process_order
+from src.order.outbox import enqueue_webhook, webhook_worker
+from src.order.resolver import invalidate_orders
 from .factory import parse_yimapay_data
 from .request_yimapay import gen_sign
 
@@ -21,7 +24,7 @@ async def yimapay_webhook(request: Request):
 
     expected_sign = gen_sign(form_data)
     if sign != expected_sign:
-        logger.error(f"Invalid sign: {sign}, expected: {exptected_sign}")
+        logger.error(f"Invalid sign: {sign}, expected: {expected_sign}")
         return {"code": "FAIL", "message": f"Invalid sign {sign}"}
 
     app_id = form_data.get("app_id")
@@ -39,6 +42,20 @@ async def yimapay_webhook(request: Request):
         logger.error(f"Invalid trade_no: {trade_no}")
         return {"ec": 400, "code": "FAIL", "message": f"Invalid trade_no {trade_no}"}
 
+    # 订单状态可能变了，之前"查不到"的结果作废
+    invalidate_orders(trade_no, form_data.get("out_trade_no"))
+
+    if settings.webhook_outbox:
+        try:
+            await run_in_db(enqueue_webhook, "yimapay", trade_no, dict(form_data))
+        except Exception as e:
+            logger.error(f"Enqueue webhook failed, trade_no: {trade_no}, error: {e}")
+            return {"code": "FAIL", "message": f"Enqueue webhook failed: {trade_no}"}
+
+        webhook_worker.wake()
+        logger.success(f"Webhook accepted, trade_no: {trade_no}")
+        return {"code": "SUCCESS", "message": "Success"}
+
     order_data = parse_yimapay_data(form_data, dict(form_data))
     if not order_data:
         logger.error(f"Parse order data failed, trade_no: {trade_no}")
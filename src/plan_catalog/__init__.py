@@ -0,0 +1,93 @@
+from time import monotonic
+from typing import Optional
+from loguru import logger
+
+from src.cache import SingleFlight, run_in_background
+from src.database import Plan, db, run_in_db
+
+
+PLAN_CATALOG_CHECK_INTERVAL = 60  # seconds，检查 plan 表是否有变化的间隔
+
+
+class PlanCatalog:
+    """
+    进程内的 Plan 目录，启动时加载，按 (platform, plan_id) 和 plan_id 建索引。
+    plan 表很小也很少变，定期用 CHECKSUM TABLE 检查，有变化才重新加载。
+    """
+
+    def __init__(self):
+        self._by_key = {}
+        self._by_plan_id = {}
+        self._version = None
+        self._checked_at = None
+        self._flight = SingleFlight()
+
+    def load(self):
+        version = db.execute_sql(f"CHECKSUM TABLE {Plan._meta.table_name}").fetchone()[1]
+        if self._checked_at is not None and version == self._version:
+            self._checked_at = monotonic()
+            return
+
+        by_key = {}
+        by_plan_id = {}
+        for plan in Plan.select().order_by(Plan.platform, Plan.plan_id):
+            by_key[(plan.platform, plan.plan_id)] = plan
+            by_plan_id.setdefault(plan.plan_id, plan)
+
+        self._by_key = by_key
+        self._by_plan_id = by_plan_id
+        self._version = version
+        self._checked_at = monotonic()
+        logger.info(f"plan catalog loaded, plans: {len(by_key)}, version: {version}")
+
+    async def refresh(self):
+        await self._flight.do("refresh", run_in_db, self.load)
+
+    def invalidate(self):
+        self._version = None
+        self._checked_at = None
+
+    def ensure_fresh(self):
+        if self._checked_at is not None and (
+            monotonic() - self._checked_at < PLAN_CATALOG_CHECK_INTERVAL
+        ):
+            return
+
+        # 后台刷新，不阻塞当前请求
+        if not self._flight.in_flight("refresh"):
+            run_in_background(self.refresh(), "plan catalog refresh")
+
+    async def get(self, platform: str, plan_id: str) -> Optional[Plan]:
+        self.ensure_fresh()
+
+        plan = self._by_key.get((platform, plan_id))
+        if plan:
+            return plan
+
+        # 可能是刚加的 plan，查一次库
+        plan = await run_in_db(
+            Plan.get_or_none, Plan.platform == platform, Plan.plan_id == plan_id
+        )
+        if plan:
+            self._by_key[(platform, plan_id)] = plan
+            self._by_plan_id.setdefault(plan_id, plan)
+        return plan
+
+    async def get_by_plan_id(self, plan_id: str) -> Optional[Plan]:
+        self.ensure_fresh()
+
+        plan = self._by_plan_id.get(plan_id)
+        if plan:
+            return plan
+
+        plan = await run_in_db(Plan.get_or_none, Plan.plan_id == plan_id)
+        if plan:
+            self._by_key.setdefault((plan.platform, plan_id), plan)
+            self._by_plan_id[plan_id] = plan
+        return plan
+
+    def titles(self) -> dict:
+        return {plan_id: plan.title for plan_id, plan in self._by_plan_id.items()}
+
+
+plan_catalog = PlanCatalog()
@@ -1,42 +1,116 @@
+import asyncio
+import base64
+import json
 from loguru import logger
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Query, Request
+from fastapi.responses import StreamingResponse
+from dataclasses import dataclass
+from functools import lru_cache
 from datetime import datetime
-from collections import defaultdict
 from time import time
+from typing import Optional, Tuple
+from peewee import fn
 
-from src.database import Bill, CheckIn, IgnoreCheckIn, Plan
+from src.cache import LRUCache, SingleFlight, run_in_background
+from src.cache.backend import create_backend
+from src.database import Bill, CheckIn, RevenueRollup, iter_rows, run_in_db
+from src.database.rollup import add_month
+from src.check_in.ignore_rules import ignore_rules
+from src.plan_catalog import plan_catalog
 from src.cdk.validate_token import validate_token
 from src.config import settings
+from src.order.transfer_order import TRANSFER_WINDOW_DAYS
+from .analytics import parse_group_by, query_range
+from .columnar import RevenueColumns
+from .snapshot import load_snapshot, save_snapshot
+from .stream import stream_ndjson
 
 router = APIRouter()
 
-cur_month_cache = {}
-cur_month_ua_cache = {}
 CACHE_EXPIRATION = 60  # seconds
+# 过期但没超过这个时间的数据先直接返回，后台刷新（stale-while-revalidate）
+CACHE_STALE_EXPIRATION = 600  # seconds
+# 以前月份的不会再变，共享缓存里放一天
+PAST_MONTH_EXPIRATION = 86400  # seconds
+# 月底之后再等这么久才认为这个月定了，写快照到磁盘。
+# 月底的订单在合并窗口内还可能被转移（transferred = -1），从这个月的收入里去掉，
+# 窗口按整天算，实际最长接近 TRANSFER_WINDOW_DAYS + 1 天，再多留一天
+SNAPSHOT_DELAY = (TRANSFER_WINDOW_DAYS + 2) * 86400  # seconds
+# 当前月份平时只增量拉新 check_in，隔这么久做一次全量重算，
+# 把订单转移、晚到的订单、提交较晚的事务这些增量看不到的变化也算进来
+FULL_REFRESH_INTERVAL = 600  # seconds
 
-past_month_cache = {}
-past_month_ua_cache = {}
+PAGE_MAX_LIMIT = 5000
 
-@router.get("/revenue")
-async def query_revenue(rid: str, date: str, request: Request, is_ua: bool = False):
-    logger.debug(f"rid: {rid}, date: {date}, is_ua: {is_ua}")
+FORMATS = ("rows", "columnar")
 
-    if not rid:
-        logger.error("rid is required")
-        return {"ec": 400, "msg": "rid is required"}
 
-    token = request.headers.get("Authorization")
-    if not token:
-        logger.error("Authorization is required")
-        return {"ec": 401, "msg": "Authorization is required"}
+@dataclass
+class RevenueEntry:
+    data: RevenueColumns
+    updated_at: float
+    watermark: int = 0  # 已经计入的最大 CheckIn.id
+    reconciled_at: float = 0  # 上次全量计算的时间
 
-    if not await validate_token(rid, token):
-        logger.error("Unauthorized")
-        return {"ec": 401, "msg": "Unauthorized"}
 
-    if not is_ua and IgnoreCheckIn.get_or_none(application=rid):
-        logger.warning(f"ignore check_in, application: {rid}")
-        return {"ec": 404, "msg": "Not Found"}
+def encode_entry(entry: RevenueEntry) -> dict:
+    return {
+        "data": entry.data.to_dict(),
+        "updated_at": entry.updated_at,
+        "watermark": entry.watermark,
+        "reconciled_at": entry.reconciled_at,
+    }
+
+
+def decode_entry(value: dict) -> RevenueEntry:
+    return RevenueEntry(
+        data=RevenueColumns.from_dict(value["data"]),
+        updated_at=value["updated_at"],
+        watermark=value["watermark"],
+        reconciled_at=value["reconciled_at"],
+    )
+
+
+@lru_cache
+def get_revenue_cache():
+    # (rid, date, is_ua) -> RevenueEntry。第一次用到时才按配置创建，import 时不读配置
+    return create_backend(
+        "revenue",
+        lambda: LRUCache(
+            "revenue",
+            max_entries=settings.revenue_cache_max_entries,
+            max_bytes=settings.revenue_cache_max_bytes,
+            sizeof=lambda entry: entry.data.nbytes(),
+        ),
+        encode=encode_entry,
+        decode=decode_entry,
+    )
+
+
+# 同一个 (rid, date, is_ua) 同时只跑一次 query_db
+revenue_flight = SingleFlight()
+
+@router.get("/revenue")
+async def query_revenue(
+    rid: str,
+    date: str,
+    request: Request,
+    is_ua: bool = False,
+    summary: bool = False,
+    stream: bool = False,
+    cursor: str = None,
+    limit: int = None,
+    format: str = "rows",
+):
+    logger.debug(f"rid: {rid}, date: {date}, is_ua: {is_ua}")
+
+    if format not in FORMATS:
+        logger.error(f"Invalid format: {format}")
+        return {"ec": 400, "msg": "Invalid format"}
+
+    error = await authorize(rid, request, is_ua)
+    if error:
+        return error
 
     try:
         dt: datetime = datetime.strptime(date, "%Y%m")
@@ -45,6 +119,7 @@ async def query_revenue(rid: str, date: str, request: Request, is_ua: bool = Fal
         return {"ec": 400, "msg": "Invalid date format"}
 
     now = datetime.now()
+    plan_catalog.ensure_fresh()
 
     if (
         dt.year < 2025
@@ -54,136 +129,381 @@ async def query_revenue(rid: str, date: str, request: Request, is_ua: bool = Fal
         logger.error(f"Invalid date: {date}")
         return {"ec": 400, "msg": "Invalid date"}
 
+    if summary:
+        # 只读汇总表，不扫 checkin / bill
+        data = await run_in_db(query_summary, rid, dt, is_ua)
+        return {"ec": 200, "data": data}
+
+    if stream or limit or cursor:
+        # 流式和分页都直接读库，不走缓存
+        try:
+            after = decode_cursor(cursor) if cursor else None
+        except ValueError:
+            logger.error(f"Invalid cursor: {cursor}")
+            return {"ec": 400, "msg": "Invalid cursor"}
+
+        if stream:
+            if format != "rows":
+                logger.error(f"Invalid format for stream: {format}")
+                return {"ec": 400, "msg": "stream only supports rows format"}
+
+            plans = plan_catalog.titles()
+            return StreamingResponse(
+                stream_ndjson(
+                    lambda after, limit: fetch_page(rid, dt, is_ua, after, limit),
+                    lambda row: revenue_row(row, plans),
+                    after,
+                ),
+                media_type="application/x-ndjson",
+            )
+
+        limit = min(limit or PAGE_MAX_LIMIT, PAGE_MAX_LIMIT)
+        if limit <= 0:
+            logger.error(f"Invalid limit: {limit}")
+            return {"ec": 400, "msg": "Invalid limit"}
+
+        data, next_cursor = await run_in_db(query_page, rid, dt, is_ua, after, limit)
+        if format == "columnar":
+            data = RevenueColumns.from_rows(data).to_dict()
+        return {"ec": 200, "data": data, "next_cursor": next_cursor}
+
+    key = (rid, date, is_ua)
+    cached = await get_revenue_cache().get(key)
+
     if dt.year == now.year and dt.month == now.month:
-        global cur_month_cache, cur_month_ua_cache
         # 现在月份的，可能会有新的数据进来，所以需要记录更新时间
-        if is_ua:
-            cache = cur_month_ua_cache
-        else:
-            cache = cur_month_cache
-
-        if rid in cache:
-            data, last_update = cache[rid]
-            timediff = int(time() - last_update)
+        if cached:
+            timediff = int(time() - cached.updated_at)
             if timediff < CACHE_EXPIRATION:
                 logger.debug(
                     f"cur month cache hit, rid: {rid}, date: {date}, timediff: {timediff}"
                 )
-                return {"ec": 200, "data": data}
+                return render(cached.data, format)
 
-        data = query_db(rid, dt, is_ua)
-        cache[rid] = (data, time())
-        return {"ec": 200, "data": data}
+            if timediff < CACHE_STALE_EXPIRATION:
+                logger.debug(
+                    f"cur month cache stale, rid: {rid}, date: {date}, timediff: {timediff}"
+                )
+                refresh_in_background(key, rid, dt, is_ua)
+                return render(cached.data, format)
 
-    else:
-        global past_month_cache, past_month_ua_cache
-        # 以前月份的，不会再有变化了，获取一次就行，不用记录update时间
+        data = await revenue_flight.do(key, load_revenue, key, rid, dt, is_ua)
+        return render(data, format)
 
-        if is_ua:
-            cache = past_month_ua_cache
+    else:
+        # 以前月份的，不会再有变化了，获取一次就行，不用管 update 时间。
+        # 但月份还没结束时算的结果缺了月底那段，要在月底之后重新全量算过才能用
+        _, next_month = month_range(dt)
+        if cached and cached.reconciled_at >= next_month.timestamp():
+            data = cached.data
+            logger.debug(f"past month cache hit, rid: {rid}, date: {date}")
         else:
-            cache = past_month_cache
+            data = await revenue_flight.do(key, load_revenue, key, rid, dt, is_ua)
 
-        if rid not in cache:
-            cache[rid] = {}
+        return render(data, format)
 
-        if date in cache[rid]:
-            data = cache[rid][date]
-            logger.debug(f"past month cache hit, rid: {rid}, date: {date}")
+
+@router.get("/revenue/range")
+async def query_revenue_range(
+    rid: str,
+    request: Request,
+    _from: str = Query(..., alias="from"),
+    to: str = None,
+    group_by: str = "day",
+    is_ua: bool = False,
+):
+    """
+    from / to 是 YYYYMMDD，两端都包含，to 默认今天。
+    group_by 用逗号分隔，可选 day / week / month（最多一个）和 platform / plan / application / user_agent
+    """
+    logger.debug(
+        f"rid: {rid}, from: {_from}, to: {to}, group_by: {group_by}, is_ua: {is_ua}"
+    )
+
+    error = await authorize(rid, request, is_ua)
+    if error:
+        return error
+
+    today = datetime.now().date()
+    try:
+        start = datetime.strptime(_from, "%Y%m%d").date()
+        end = datetime.strptime(to, "%Y%m%d").date() if to else today
+    except ValueError:
+        logger.error(f"Invalid date format, from: {_from}, to: {to}")
+        return {"ec": 400, "msg": "Invalid date format"}
+
+    if start.year < 2025 or start > end:
+        logger.error(f"Invalid date range, from: {_from}, to: {to}")
+        return {"ec": 400, "msg": "Invalid date range"}
+
+    try:
+        fields = parse_group_by(group_by)
+    except ValueError as e:
+        logger.error(f"Invalid group_by: {e}")
+        return {"ec": 400, "msg": "Invalid group_by"}
+
+    plan_catalog.ensure_fresh()
+    data, source = await run_in_db(query_range, rid, start, min(end, today), is_ua, fields)
+    return {"ec": 200, "data": data, "source": source}
+
+
+async def authorize(rid: str, request: Request, is_ua: bool) -> Optional[dict]:
+    """
+    校验 rid 和 token，通过返回 None，否则返回错误响应
+    """
+    if not rid:
+        logger.error("rid is required")
+        return {"ec": 400, "msg": "rid is required"}
+
+    token = request.headers.get("Authorization")
+    if not token:
+        logger.error("Authorization is required")
+        return {"ec": 401, "msg": "Authorization is required"}
+
+    if not await validate_token(rid, token):
+        logger.error("Unauthorized")
+        return {"ec": 401, "msg": "Unauthorized"}
+
+    ignore_rules.ensure_fresh()
+    if not is_ua and ignore_rules.match(application=rid):
+        logger.warning(f"ignore check_in, application: {rid}")
+        return {"ec": 404, "msg": "Not Found"}
+
+    return None
+
+
+def render(data: RevenueColumns, format: str) -> dict:
+    if format == "columnar":
+        return {"ec": 200, "format": "columnar", "data": data.to_dict()}
+    return {"ec": 200, "data": data.to_rows()}
+
+
+async def load_revenue(key, rid: str, dt: datetime, is_ua: bool):
+    now = datetime.now()
+    is_cur_month = dt.year == now.year and dt.month == now.month
+
+    entry = await get_revenue_cache().get(key)
+    if (
+        entry
+        and is_cur_month
+        and time() - entry.reconciled_at < FULL_REFRESH_INTERVAL
+    ):
+        # 只拉 watermark 之后新增的 check_in，追加到已有的结果后面
+        data, watermark = await run_in_db(query_db, rid, dt, is_ua, entry.watermark)
+        if len(data):
+            # 复制一份再追加，已经返回出去的旧对象不受影响
+            merged = entry.data.copy()
+            merged.extend(data.to_rows())
+            data = merged
         else:
-            data = query_db(rid, dt, is_ua)
-            cache[rid][date] = data
+            data = entry.data
+        entry = RevenueEntry(
+            data=data,
+            updated_at=time(),
+            watermark=watermark,
+            reconciled_at=entry.reconciled_at,
+        )
+    else:
+        finalized = is_finalized(dt, now)
+        snapshot = await asyncio.to_thread(load_snapshot, key) if finalized else None
+        if snapshot is not None:
+            # 已经定下来的月份优先读磁盘快照，重启后不用再扫库
+            entry = RevenueEntry(data=snapshot, updated_at=time(), reconciled_at=time())
+        else:
+            data, watermark = await run_in_db(query_db, rid, dt, is_ua)
+            entry = RevenueEntry(
+                data=data, updated_at=time(), watermark=watermark, reconciled_at=time()
+            )
+            if finalized:
+                run_in_background(
+                    asyncio.to_thread(save_snapshot, key, data), f"revenue snapshot {key}"
+                )
+
+    ttl = CACHE_STALE_EXPIRATION if is_cur_month else PAST_MONTH_EXPIRATION
+    await get_revenue_cache().set(key, entry, ttl)
+    return entry.data
 
-        return {"ec": 200, "data": data}
 
+def is_finalized(dt: datetime, now: datetime) -> bool:
+    _, next_month = month_range(dt)
+    return (now - next_month).total_seconds() >= SNAPSHOT_DELAY
 
-def query_db(rid: str, date: datetime, is_ua: bool):
-    logger.debug(f"query_db, rid: {rid}, date: {date}, is_ua: {is_ua}")
 
-    plans = {plan.plan_id: plan.title for plan in Plan.select(Plan.plan_id, Plan.title)}
+def refresh_in_background(key, rid: str, dt: datetime, is_ua: bool):
+    if revenue_flight.in_flight(key):
+        return
+
+    run_in_background(
+        revenue_flight.do(key, load_revenue, key, rid, dt, is_ua),
+        f"revenue refresh {key}",
+    )
 
+
+def month_range(date: datetime):
     cur_month = datetime(date.year, date.month, 1)
+    return cur_month, add_month(cur_month)
 
-    if date.month == 12:
-        next_month = datetime(date.year + 1, 1, 1)
-    else:
-        next_month = datetime(date.year, date.month + 1, 1)
 
-    if rid == settings.revenue_all_secret:
-        checkins = (
-            CheckIn.select(
-                CheckIn.cdk,
-                CheckIn.activated_at,
-                CheckIn.application,
-                CheckIn.user_agent,
-            )
-            .where(
-                CheckIn.activated_at.between(cur_month, next_month),
-            )
-            .order_by(CheckIn.activated_at)
+def revenue_query(rid: str, date: datetime, is_ua: bool, after: tuple = None):
+    """
+    CheckIn JOIN Bill，一条 SQL 查出这个月的所有 (激活, 订单) 行，
+    按 (激活时间, CheckIn.id) 排序，可以直接走 activated_at 索引（二级索引里带着主键）。
+    after 是上一页最后一个 check_in 的 (activated_at, id)
+    """
+    cur_month, next_month = month_range(date)
+
+    query = (
+        CheckIn.select(
+            CheckIn.activated_at,
+            CheckIn.application,
+            CheckIn.user_agent,
+            Bill.platform,
+            Bill.plan_id,
+            Bill.buy_count,
+            Bill.actually_paid,
+            CheckIn.id,
         )
-    elif not is_ua:
-        checkins = (
-            CheckIn.select(
-                CheckIn.cdk,
-                CheckIn.activated_at,
-                CheckIn.application,
-                CheckIn.user_agent,
-            )
-            .where(
-                CheckIn.application == rid,
-                CheckIn.activated_at.between(cur_month, next_month),
-            )
-            .order_by(CheckIn.activated_at)
+        .join(Bill, on=(Bill.cdk == CheckIn.cdk))
+        .where(
+            CheckIn.activated_at.between(cur_month, next_month),
+            Bill.transferred >= 0,
         )
-    else: # is_ua
-        checkins = (
-            CheckIn.select(
-                CheckIn.cdk,
-                CheckIn.activated_at,
-                CheckIn.application,
-                CheckIn.user_agent,
-            )
-            .where(
-                CheckIn.user_agent == rid,
-                CheckIn.activated_at.between(cur_month, next_month),
-            )
-            .order_by(CheckIn.activated_at)
+        .order_by(CheckIn.activated_at, CheckIn.id)
+    )
+
+    if after:
+        activated_at, checkin_id = after
+        # 第一个条件单独写出来，MySQL 才能用它缩小索引范围
+        query = query.where(
+            CheckIn.activated_at >= activated_at,
+            (CheckIn.activated_at > activated_at)
+            | ((CheckIn.activated_at == activated_at) & (CheckIn.id > checkin_id)),
         )
 
-    bills = Bill.select(
-        Bill.platform, Bill.plan_id, Bill.created_at, Bill.buy_count, Bill.actually_paid, Bill.cdk
-    ).where(
-        Bill.cdk << [checkin.cdk for checkin in checkins],
-        Bill.transferred >= 0,
+    if rid == settings.revenue_all_secret:
+        return query
+
+    if is_ua:
+        return query.where(CheckIn.user_agent == rid)
+
+    return query.where(CheckIn.application == rid)
+
+
+def revenue_row(row, plans: dict) -> dict:
+    activated_at, app, ua, platform, plan_id, buy_count, amount = row[:7]
+    return {
+        "platform": platform,
+        "activated_at": activated_at,
+        "application": app,
+        "user_agent": ua if ua else f"{app}-NoUA",
+        "plan": plans.get(plan_id, plan_id),
+        "buy_count": buy_count,
+        "amount": amount,
+    }
+
+
+def query_db(
+    rid: str, date: datetime, is_ua: bool, after_id: int = 0
+) -> Tuple[RevenueColumns, int]:
+    """
+    查询 CheckIn.id 在 (after_id, watermark] 之间的收入明细，返回列式的 (data, watermark)
+    """
+    logger.debug(f"query_db, rid: {rid}, date: {date}, is_ua: {is_ua}, after_id: {after_id}")
+
+    plans = plan_catalog.titles()
+
+    # 先定下这次的上界，保证下次增量从这里接着查
+    watermark = CheckIn.select(fn.MAX(CheckIn.id)).scalar() or 0
+    if watermark <= after_id:
+        return RevenueColumns(), after_id
+
+    query = revenue_query(rid, date, is_ua).where(
+        CheckIn.id > after_id, CheckIn.id <= watermark
+    )
+    data = RevenueColumns.from_rows(revenue_row(row, plans) for row in iter_rows(query))
+
+    logger.success(
+        f"query_db success, rid: {rid}, date: {date}, is_ua: {is_ua}, after_id: {after_id}, len(data): {len(data)}"
     )
+    return data, watermark
+
+
+def page_key(row) -> tuple:
+    # (activated_at, CheckIn.id)
+    return row[0], row[7]
+
+
+def encode_cursor(key: tuple) -> str:
+    activated_at, checkin_id = key
+    raw = json.dumps([activated_at.isoformat(), checkin_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
 
-    bill_dict = defaultdict(list)
-    for bill in bills:
-        bill_dict[bill.cdk].append(bill)
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        activated_at, checkin_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(activated_at), int(checkin_id)
+    except Exception as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+
+
+def fetch_page(rid: str, date: datetime, is_ua: bool, after: tuple, limit: int):
+    """
+    返回 (rows, next_after)，rows 是 revenue_query 的原始行，没有下一页时 next_after 为 None
+    """
+    # 多取一行用来判断还有没有下一页
+    query = revenue_query(rid, date, is_ua, after)
+    rows = list(query.limit(limit + 1).tuples())
+    if len(rows) <= limit:
+        return rows, None
+
+    # 游标是按 check_in 算的，同一个 check_in 的几笔订单不能拆到两页，
+    # 去掉和下一页第一行属于同一个 check_in 的行
+    boundary = page_key(rows[limit])
+    page = [row for row in rows[:limit] if page_key(row) != boundary]
+    if not page:
+        # 一个 check_in 的订单比 limit 还多，整个放进这一页
+        page = list(query.where(CheckIn.id == boundary[1]).tuples())
+
+    return page, page_key(page[-1])
+
+
+def query_page(rid: str, date: datetime, is_ua: bool, after: tuple, limit: int):
+    plans = plan_catalog.titles()
+
+    rows, next_after = fetch_page(rid, date, is_ua, after, limit)
+    next_cursor = encode_cursor(next_after) if next_after else None
+    return [revenue_row(row, plans) for row in rows], next_cursor
+
+
+def query_summary(rid: str, date: datetime, is_ua: bool):
+    plans = plan_catalog.titles()
+
+    query = RevenueRollup.select().where(
+        RevenueRollup.month == date.strftime("%Y%m"), RevenueRollup.count != 0
+    )
+    if rid != settings.revenue_all_secret:
+        if is_ua:
+            query = query.where(RevenueRollup.user_agent == rid)
+        else:
+            query = query.where(RevenueRollup.application == rid)
 
     data = []
-    for checkin in checkins:
-        cur_bills = bill_dict.get(checkin.cdk, [])
-        if not cur_bills:
-            continue
-
-        for b in cur_bills:
-            app = checkin.application
-            ua = checkin.user_agent if checkin.user_agent else f"{app}-NoUA"
-            data.append(
-                {
-                    "platform": b.platform,
-                    "activated_at": checkin.activated_at,
-                    "application": app,
-                    "user_agent": ua,
-                    "plan": plans[b.plan_id],
-                    "buy_count": b.buy_count,
-                    "amount": b.actually_paid,
-                }
-            )
+    for rollup in query:
+        app = rollup.application
+        data.append(
+            {
+                "platform": rollup.platform,
+                "application": app,
+                "user_agent": rollup.user_agent if rollup.user_agent else f"{app}-NoUA",
+                "plan": plans.get(rollup.plan_id, rollup.plan_id),
+                "count": rollup.count,
+                "buy_count": rollup.buy_count,
+                "amount": str(rollup.amount),
+            }
+        )
 
     logger.success(
-        f"query_db success, rid: {rid}, date: {date}, is_ua: {is_ua}, len(data): {len(data)}"
+        f"query_summary success, rid: {rid}, date: {date}, is_ua: {is_ua}, len(data): {len(data)}"
     )
     return data
@@ -0,0 +1,227 @@
+from collections import defaultdict
+from itertools import chain
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from loguru import logger
+from peewee import fn, Cast
+
+from src.config import settings
+from src.database import Bill, CheckIn, RevenueRollup, RevenueRollupMonth
+from src.database.rollup import add_month, parse_amount
+from src.plan_catalog import plan_catalog
+
+
+PERIODS = ("day", "week", "month")
+DIMENSIONS = ("platform", "plan", "application", "user_agent")
+
+
+def parse_group_by(group_by: str) -> list:
+    """
+    "month,platform" -> ["month", "platform"]，时间粒度最多一个，不认识的字段抛 ValueError
+    """
+    fields = [field.strip() for field in group_by.split(",") if field.strip()]
+    for field in fields:
+        if field not in PERIODS and field not in DIMENSIONS:
+            raise ValueError(f"unknown group_by field: {field}")
+    if len(fields) != len(set(fields)):
+        raise ValueError(f"duplicated group_by field: {group_by}")
+    if sum(field in PERIODS for field in fields) > 1:
+        raise ValueError(f"more than one period in group_by: {group_by}")
+    return fields
+
+
+def period_of(day: date, period: str) -> str:
+    if period == "day":
+        return day.isoformat()
+    if period == "week":
+        # 以周一代表这一周
+        return (day - timedelta(days=day.weekday())).isoformat()
+    return day.strftime("%Y-%m")
+
+
+def covers_whole_months(start: date, end: date) -> bool:
+    """
+    [start, end] 是否由完整的月份组成，end 到今天及以后的当月也算完整
+    """
+    if start.day != 1:
+        return False
+    if end >= date.today():
+        return True
+    return (end + timedelta(days=1)).day == 1
+
+
+def label(row: dict, fields: list, plans: dict) -> tuple:
+    key = []
+    for field in fields:
+        if field in PERIODS:
+            key.append(row["period"])
+        elif field == "plan":
+            key.append(plans.get(row["plan_id"], row["plan_id"]))
+        elif field == "user_agent":
+            ua = row["user_agent"]
+            key.append(ua if ua else f"{row['application']}-NoUA")
+        else:
+            key.append(row[field])
+    return tuple(key)
+
+
+def fold(rows, fields: list) -> list:
+    """
+    把按原始列分组的结果再按请求的字段合并，输出每组的 count / buy_count / amount
+    """
+    plans = plan_catalog.titles()
+
+    groups = defaultdict(lambda: [0, 0, Decimal(0)])
+    for row in rows:
+        group = groups[label(row, fields, plans)]
+        group[0] += row["count"]
+        group[1] += row["buy_count"] or 0
+        group[2] += parse_amount(row["amount"] or 0)
+
+    data = []
+    for key in sorted(groups):
+        count, buy_count, amount = groups[key]
+        if not count:
+            continue
+
+        item = {("period" if field in PERIODS else field): value for field, value in zip(fields, key)}
+        item.update(count=count, buy_count=buy_count, amount=str(amount))
+        data.append(item)
+    return data
+
+
+def filter_rid(query, application, user_agent, rid: str, is_ua: bool):
+    if rid == settings.revenue_all_secret:
+        return query
+    if is_ua:
+        return query.where(user_agent == rid)
+    return query.where(application == rid)
+
+
+def months_between(start: date, end: date) -> list:
+    months = []
+    cur = datetime(start.year, start.month, 1)
+    while cur.date() <= end:
+        months.append(cur)
+        cur = add_month(cur)
+    return months
+
+
+def uncovered_ranges(months: list, covered: set, start: date, end: date) -> list:
+    """
+    没有重算过的月份，相邻的合并成一段 [first, last]，并裁剪到 [start, end]
+    """
+    ranges = []
+    for month in months:
+        if month.strftime("%Y%m") in covered:
+            continue
+        first = max(month.date(), start)
+        last = min(add_month(month).date() - timedelta(days=1), end)
+        if ranges and ranges[-1][1] + timedelta(days=1) == first:
+            ranges[-1][1] = last
+        else:
+            ranges.append([first, last])
+    return ranges
+
+
+def query_rollup_rows(rid: str, months: list, is_ua: bool, period: str):
+    query = RevenueRollup.select().where(
+        RevenueRollup.month << months, RevenueRollup.count != 0
+    )
+    query = filter_rid(query, RevenueRollup.application, RevenueRollup.user_agent, rid, is_ua)
+
+    for rollup in query:
+        yield {
+            "period": f"{rollup.month[:4]}-{rollup.month[4:]}" if period else None,
+            "platform": rollup.platform,
+            "plan_id": rollup.plan_id,
+            "application": rollup.application,
+            "user_agent": rollup.user_agent,
+            "count": rollup.count,
+            "buy_count": rollup.buy_count,
+            "amount": rollup.amount,
+        }
+
+
+def query_db_rows(rid: str, start: date, end: date, is_ua: bool, fields: list, period: str):
+    """
+    在库里 GROUP BY 聚合；时间统一按天分组，周、月在内存里再合并，不依赖数据库的日期函数
+    """
+    columns = []
+    if period:
+        columns.append(fn.DATE(CheckIn.activated_at).alias("day"))
+    if "platform" in fields:
+        columns.append(Bill.platform)
+    if "plan" in fields:
+        columns.append(Bill.plan_id)
+    if "application" in fields or "user_agent" in fields:
+        # 没有 UA 的按 "{application}-NoUA" 区分，所以按 UA 分组时也要带上 application
+        columns.append(CheckIn.application)
+    if "user_agent" in fields:
+        columns.append(CheckIn.user_agent)
+
+    query = (
+        CheckIn.select(
+            *columns,
+            fn.COUNT(CheckIn.id).alias("count"),
+            fn.SUM(Bill.buy_count).alias("buy_count"),
+            fn.SUM(Cast(Bill.actually_paid, "DECIMAL(16, 2)")).alias("amount"),
+        )
+        .join(Bill, on=(Bill.cdk == CheckIn.cdk))
+        .where(
+            CheckIn.activated_at >= datetime.combine(start, datetime.min.time()),
+            CheckIn.activated_at < datetime.combine(end + timedelta(days=1), datetime.min.time()),
+            Bill.transferred >= 0,
+        )
+        .dicts()
+    )
+    if columns:
+        query = query.group_by(*columns)
+    query = filter_rid(query, CheckIn.application, CheckIn.user_agent, rid, is_ua)
+
+    for row in query:
+        if period:
+            day = row.pop("day")
+            if isinstance(day, datetime):
+                day = day.date()
+            elif not isinstance(day, date):
+                day = date.fromisoformat(str(day)[:10])
+            row["period"] = period_of(day, period)
+        yield row
+
+
+def query_range(rid: str, start: date, end: date, is_ua: bool, fields: list):
+    """
+    返回 (data, source)。按月或不分时间、且范围是整月时，重算过的月份读汇总表，
+    其余的（还没 backfill 过的月份、非整月、按天 / 周）在库里聚合明细
+    """
+    period = next((field for field in fields if field in PERIODS), None)
+
+    if period in (None, "month") and covers_whole_months(start, end):
+        months = months_between(start, end)
+        keys = [month.strftime("%Y%m") for month in months]
+        covered = {
+            row.month
+            for row in RevenueRollupMonth.select(RevenueRollupMonth.month).where(
+                RevenueRollupMonth.month << keys
+            )
+        }
+        ranges = uncovered_ranges(months, covered, start, end)
+
+        parts = []
+        if covered:
+            parts.append(query_rollup_rows(rid, sorted(covered), is_ua, period))
+        for first, last in ranges:
+            parts.append(query_db_rows(rid, first, last, is_ua, fields, period))
+
+        source = "db" if not covered else "mixed" if ranges else "rollup"
+        rows = chain(*parts)
+    else:
+        source = "db"
+        rows = query_db_rows(rid, start, end, is_ua, fields, period)
+
+    data = fold(rows, fields)
+    logger.success(
+        f"query_range success, rid: {rid}, from: {start}, to: {end}, is_ua: {is_ua}, group_by: {fields}, source: {source}, len(data): {len(data)}"
+    )
+    return data, source
@@ -0,0 +1,120 @@
+import sys
+from array import array
+from datetime import datetime
+from typing import Iterable
+
+
+STRING_COLUMNS = ("platform", "application", "user_agent", "plan")
+COLUMNS = ("platform", "activated_at", "application", "user_agent", "plan", "buy_count", "amount")
+
+
+class RevenueColumns:
+    """
+    列式存储的收入明细：每个字段一个数组，platform / application / user_agent / plan
+    存成字典里的下标，activated_at 存成秒级时间戳
+    """
+
+    def __init__(self):
+        self.dicts = {name: [] for name in STRING_COLUMNS}
+        self._index = {name: {} for name in STRING_COLUMNS}  # value -> 下标
+        self.columns = {
+            "platform": array("l"),
+            "activated_at": array("q"),
+            "application": array("l"),
+            "user_agent": array("l"),
+            "plan": array("l"),
+            "buy_count": array("q"),
+            "amount": [],
+        }
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[dict]) -> "RevenueColumns":
+        columns = cls()
+        columns.extend(rows)
+        return columns
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "RevenueColumns":
+        """
+        to_dict 的逆操作
+        """
+        columns = cls()
+        columns.dicts = {name: list(data["dicts"][name]) for name in STRING_COLUMNS}
+        columns._index = {
+            name: {value: index for index, value in enumerate(values)}
+            for name, values in columns.dicts.items()
+        }
+        for name, column in columns.columns.items():
+            column.extend(data["columns"][name])
+        return columns
+
+    def _encode(self, name: str, value) -> int:
+        index = self._index[name].get(value)
+        if index is None:
+            index = len(self.dicts[name])
+            self._index[name][value] = index
+            self.dicts[name].append(value)
+        return index
+
+    def append(self, row: dict):
+        for name in STRING_COLUMNS:
+            self.columns[name].append(self._encode(name, row[name]))
+        self.columns["activated_at"].append(int(row["activated_at"].timestamp()))
+        self.columns["buy_count"].append(row["buy_count"])
+        self.columns["amount"].append(row["amount"])
+
+    def extend(self, rows: Iterable[dict]):
+        for row in rows:
+            self.append(row)
+
+    def copy(self) -> "RevenueColumns":
+        columns = RevenueColumns()
+        columns.dicts = {name: list(values) for name, values in self.dicts.items()}
+        columns._index = {name: dict(index) for name, index in self._index.items()}
+        columns.columns = {name: column[:] for name, column in self.columns.items()}
+        return columns
+
+    def __len__(self):
+        return len(self.columns["activated_at"])
+
+    def to_rows(self) -> list:
+        """
+        还原成原来的一行一个 dict 的格式
+        """
+        platforms, apps, uas, plans = (self.dicts[name] for name in STRING_COLUMNS)
+        c = self.columns
+        return [
+            {
+                "platform": platforms[platform],
+                "activated_at": datetime.fromtimestamp(activated_at),
+                "application": apps[app],
+                "user_agent": uas[ua],
+                "plan": plans[plan],
+                "buy_count": buy_count,
+                "amount": amount,
+            }
+            for platform, activated_at, app, ua, plan, buy_count, amount in zip(
+                *(c[name] for name in COLUMNS)
+            )
+        ]
+
+    def to_dict(self) -> dict:
+        return {
+            "count": len(self),
+            "dicts": self.dicts,
+            "columns": {name: list(column) for name, column in self.columns.items()},
+        }
+
+    def nbytes(self) -> int:
+        """
+        估算占用的内存，给 LRUCache 算预算用
+        """
+        size = sum(sys.getsizeof(column) for column in self.columns.values())
+        # amount 是字符串/Decimal 列表，按第一个元素估算
+        amounts = self.columns["amount"]
+        if amounts:
+            size += sys.getsizeof(amounts[0]) * len(amounts)
+        for values in self.dicts.values():
+            # 字典本身加上反查用的 index
+            size += sum(sys.getsizeof(value) for value in values) * 2
+        return size
@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+import tempfile
+from typing import Optional
+from loguru import logger
+
+from src.config import settings
+from .columnar import RevenueColumns
+
+
+SNAPSHOT_VERSION = 1
+
+
+def snapshot_path(key) -> Optional[str]:
+    """
+    key: (rid, date, is_ua)，文件名里不放 rid 明文
+    """
+    if not settings.revenue_snapshot_dir:
+        return None
+
+    rid, date, is_ua = key
+    digest = hashlib.sha1(json.dumps([rid, is_ua]).encode()).hexdigest()
+    return os.path.join(settings.revenue_snapshot_dir, f"{date}-{digest}.json")
+
+
+def load_snapshot(key) -> Optional[RevenueColumns]:
+    path = snapshot_path(key)
+    if not path or not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, "rb") as f:
+            snapshot = json.load(f)
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            logger.warning(f"snapshot version mismatch, path: {path}")
+            return None
+        data = RevenueColumns.from_dict(snapshot["data"])
+    except Exception as e:
+        logger.error(f"load snapshot failed, path: {path}, error: {e}")
+        return None
+
+    logger.debug(f"snapshot loaded, path: {path}, len(data): {len(data)}")
+    return data
+
+
+def save_snapshot(key, data: RevenueColumns):
+    """
+    先写临时文件再 rename，读的一方不会看到写了一半的文件
+    """
+    path = snapshot_path(key)
+    if not path:
+        return
+
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(
+                    {"version": SNAPSHOT_VERSION, "data": data.to_dict()},
+                    f,
+                    separators=(",", ":"),
+                    ensure_ascii=False,
+                )
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except Exception as e:
+        logger.error(f"save snapshot failed, path: {path}, error: {e}")
+        return
+
+    logger.success(f"snapshot saved, path: {path}, len(data): {len(data)}")
@@ -0,0 +1,40 @@
+import json
+from datetime import datetime
+from loguru import logger
+
+from src.database import run_in_db
+
+
+STREAM_PAGE_SIZE = 2000  # 每页查询的行数，每页单独占用一次连接和 db 线程
+
+
+def json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"{type(obj)} is not JSON serializable")
+
+
+async def stream_ndjson(fetch_page, to_dict, after: tuple = None):
+    """
+    按 keyset 一页一页查，编码成 NDJSON 发出去。
+    fetch_page(after, limit) -> (rows, next_after)，next_after 为 None 表示没有下一页。
+    每页查完就把连接和 db 线程还回去，客户端读得慢只会推迟下一页的查询，
+    不会一直占着游标，也不会碰到 net_write_timeout。
+    """
+    while True:
+        try:
+            rows, after = await run_in_db(fetch_page, after, STREAM_PAGE_SIZE)
+        except Exception as e:
+            # 响应头已经发出去了，用最后一行告诉客户端数据不完整
+            logger.error(f"revenue stream failed, after: {after}, error: {e}")
+            yield json.dumps({"ec": 500, "msg": "Stream interrupted"}) + "\n"
+            return
+
+        if rows:
+            yield "".join(
+                json.dumps(to_dict(row), default=json_default, ensure_ascii=False) + "\n"
+                for row in rows
+            )
+
+        if after is None:
+            return
@@ -1,13 +1,13 @@
 from fastapi import APIRouter
 
-from src.database import Reward
+from src.database import Reward, run_in_db
 
 router = APIRouter()
 
 
 @router.get("/reward")
-def query_reward(reward_key: str):
-    reward = Reward.get_or_none(Reward.reward_key == reward_key)
+async def query_reward(reward_key: str):
+    reward = await run_in_db(Reward.get_or_none, Reward.reward_key == reward_key)
     if not reward:
         return {"ec": 404, "msg": "Reward not found"}
 